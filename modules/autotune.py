@@ -0,0 +1,144 @@
+import json
+import os
+import platform
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional
+import cv2
+import onnxruntime
+
+import modules.core
+import modules.globals
+import modules.face_analyser
+from modules.capturer import get_video_frame, get_video_frame_total
+from modules.processors.frame.core import FrameProcessor, get_frame_processors, setup_frame_processors, release_thread_instances, process_batch
+from modules.typing import Frame
+from modules.utilities import has_image_extension, resolve_relative_path
+
+AUTOTUNE_SAMPLE_FRAMES = 16
+AUTOTUNE_BATCH_SIZES = [4, 16]
+AUTOTUNE_TASKS_PER_THREAD = 2
+AUTOTUNE_CANDIDATE_SECONDS = 5.0
+PROFILE_DIRECTORY = '../profiles'
+
+
+def get_profile_path() -> str:
+    host_name = platform.node() or 'localhost'
+    return resolve_relative_path(os.path.join(PROFILE_DIRECTORY, f'{host_name}-{platform.machine()}.json'))
+
+
+def load_profile() -> Optional[Dict[str, Any]]:
+    profile_path = get_profile_path()
+    if os.path.isfile(profile_path):
+        with open(profile_path) as profile_file:
+            profile = json.load(profile_file)
+        if all(provider in onnxruntime.get_available_providers() for provider in profile.get('execution_providers', [])):
+            return profile
+    return None
+
+
+def save_profile(profile: Dict[str, Any]) -> None:
+    profile_path = get_profile_path()
+    os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    with open(profile_path, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=4)
+
+
+def suggest_thread_counts() -> List[int]:
+    cpu_count = os.cpu_count() or 1
+    thread_counts = [1]
+    while thread_counts[-1] * 2 <= cpu_count * 2 and thread_counts[-1] < 32:
+        thread_counts.append(thread_counts[-1] * 2)
+    return thread_counts
+
+
+def suggest_provider_choices() -> List[List[str]]:
+    available_providers = [provider for provider in onnxruntime.get_available_providers() if provider != 'TensorrtExecutionProvider']
+    return [[provider] for provider in available_providers]
+
+
+def extract_sample_frames(target_path: str, sample_total: int) -> List[Frame]:
+    if has_image_extension(target_path):
+        frame = cv2.imread(target_path)
+        return [frame] if frame is not None else []
+    frame_total = get_video_frame_total(target_path)
+    frame_numbers = [frame_total * index // sample_total + 1 for index in range(sample_total)]
+    return [frame for frame in (get_video_frame(target_path, frame_number) for frame_number in frame_numbers) if frame is not None]
+
+
+def reset_models(frame_processors: List[FrameProcessor]) -> None:
+    modules.face_analyser.clear_face_analyser()
+    for frame_processor in frame_processors:
+        if 'execution_providers' in frame_processor.RESOURCES:
+            frame_processor.teardown()
+
+
+def measure_throughput(frame_processors: List[FrameProcessor], sample_frames: List[Frame], time_budget: float) -> float:
+    source_face = modules.core.get_source_face()
+    execution_threads = modules.globals.execution_threads or 1
+    batch_size = modules.globals.execution_batch_size or 1
+    setup_frame_processors(frame_processors)
+    frame_count = 0
+    task_count = 0
+    start_time = time.perf_counter()
+    # the sample frames are cycled in memory, every candidate runs for the same time whatever its batch size
+    with ThreadPoolExecutor(max_workers=execution_threads) as executor:
+        futures: Deque[Future[List[Frame]]] = deque()
+        while True:
+            while len(futures) < execution_threads * AUTOTUNE_TASKS_PER_THREAD and (task_count < execution_threads or time.perf_counter() - start_time < time_budget):
+                temp_frames = [sample_frames[(task_count * batch_size + index) % len(sample_frames)].copy() for index in range(batch_size)]
+                futures.append(executor.submit(process_batch, source_face, temp_frames, frame_processors))
+                task_count += 1
+            if not futures:
+                break
+            frame_count += len(futures.popleft().result())
+    release_thread_instances()
+    return frame_count / (time.perf_counter() - start_time)
+
+
+def measure_candidates(frame_processors: List[FrameProcessor], sample_frames: List[Frame], candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    best_candidate: Dict[str, Any] = {}
+    for candidate in candidates:
+        apply_profile(candidate)
+        fps = measure_throughput(frame_processors, sample_frames, AUTOTUNE_CANDIDATE_SECONDS)
+        modules.core.update_status(f"Autotune {candidate['execution_providers']} threads {candidate['execution_threads']} batch {candidate['execution_batch_size']}: {fps:.2f} fps")
+        if not best_candidate or fps > best_candidate['fps']:
+            best_candidate = dict(candidate, fps=fps)
+    return best_candidate
+
+
+def autotune() -> Optional[Dict[str, Any]]:
+    frame_processors = get_frame_processors(modules.globals.frame_processors)
+    for frame_processor in frame_processors:
+        if not frame_processor.pre_start():
+            return None
+    best_profile: Dict[str, Any] = {}
+    sample_frames = extract_sample_frames(modules.globals.target_path, AUTOTUNE_SAMPLE_FRAMES)
+    if not sample_frames:
+        modules.core.update_status('Autotune failed to read sample frames.')
+        return None
+    for execution_providers in suggest_provider_choices():
+        reset_models(frame_processors)
+        # warm up so model loading is not measured
+        apply_profile({'execution_providers': execution_providers, 'execution_threads': 1, 'execution_batch_size': 1})
+        measure_throughput(frame_processors, sample_frames, 0)
+        # tune the thread count first, then the batch size on top of it
+        best_candidate = measure_candidates(frame_processors, sample_frames, [{'execution_providers': execution_providers, 'execution_threads': execution_threads, 'execution_batch_size': 1} for execution_threads in suggest_thread_counts()])
+        best_candidate = measure_candidates(frame_processors, sample_frames, [dict(best_candidate, execution_batch_size=execution_batch_size) for execution_batch_size in [1] + AUTOTUNE_BATCH_SIZES])
+        if not best_profile or best_candidate['fps'] > best_profile['fps']:
+            best_profile = best_candidate
+    reset_models(frame_processors)
+    apply_profile(best_profile)
+    save_profile(best_profile)
+    modules.core.update_status(f"Autotune picked {best_profile['execution_providers']} threads {best_profile['execution_threads']} batch {best_profile['execution_batch_size']} ({best_profile['fps']:.2f} fps)")
+    return best_profile
+
+
+def apply_profile(profile: Dict[str, Any], execution_providers: bool = True, execution_threads: bool = True, execution_batch_size: bool = True) -> None:
+    if execution_providers:
+        modules.globals.execution_providers = profile['execution_providers']
+    if execution_threads:
+        modules.globals.execution_threads = profile['execution_threads']
+    if execution_batch_size:
+        modules.globals.execution_batch_size = profile['execution_batch_size']
@@ -0,0 +1,299 @@
+import glob
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import struct
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import modules.core
+import modules.globals
+from modules.processors.frame.core import get_frame_processors, process_video
+from modules.utilities import TEMP_FRAME_FORMAT, run_ffmpeg, get_file_digest, detect_fps, detect_frame_total, create_temp, clean_temp, get_temp_directory_path, get_temp_output_path
+
+MESSAGE_HEADER = struct.Struct('!IQ')
+CHUNK_SIZE = 1024 * 1024
+TASK_TIMEOUT = 3600
+STRAGGLER_FACTOR = 2.0
+MAX_ATTEMPTS = 3
+CONNECT_RETRIES = 30
+CLUSTER_SETTINGS = [
+    'frame_processors',
+    'fp_ui',
+    'many_faces',
+    'video_encoder',
+    'video_quality'
+]
+
+TASKS: List[Dict[str, Any]] = []
+TASK_DURATIONS: List[float] = []
+TASK_CONDITION = threading.Condition()
+
+
+def parse_address(address: str) -> Tuple[int, Any]:
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def create_server(address: str) -> socket.socket:
+    family, socket_address = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(socket_address):
+        os.remove(socket_address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(socket_address)
+    server.listen()
+    return server
+
+
+def connect(address: str) -> socket.socket:
+    family, socket_address = parse_address(address)
+    for _ in range(CONNECT_RETRIES):
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            connection.connect(socket_address)
+            return connection
+        except OSError:
+            connection.close()
+            time.sleep(1)
+    raise ConnectionError(f'Could not connect to coordinator at {address}')
+
+
+def send_message(connection: socket.socket, header: Dict[str, Any], payload_path: Optional[str] = None) -> None:
+    header_bytes = json.dumps(header).encode()
+    payload_size = os.path.getsize(payload_path) if payload_path else 0
+    connection.sendall(MESSAGE_HEADER.pack(len(header_bytes), payload_size) + header_bytes)
+    if payload_path:
+        with open(payload_path, 'rb') as payload_file:
+            connection.sendfile(payload_file)
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('Connection closed')
+        received += count
+    return bytes(buffer)
+
+
+def receive_message(connection: socket.socket, payload_path: Optional[str] = None) -> Dict[str, Any]:
+    header_size, payload_size = MESSAGE_HEADER.unpack(receive_exactly(connection, MESSAGE_HEADER.size))
+    header = json.loads(receive_exactly(connection, header_size))
+    if payload_size:
+        # payloads without a destination are drained
+        with open(payload_path or os.devnull, 'wb') as payload_file:
+            while payload_size:
+                chunk = receive_exactly(connection, min(payload_size, CHUNK_SIZE))
+                payload_file.write(chunk)
+                payload_size -= len(chunk)
+    return header
+
+
+def create_tasks(first_frame: int, last_frame: int, segment_frames: int) -> None:
+    with TASK_CONDITION:
+        TASKS.clear()
+        TASK_DURATIONS.clear()
+        for task_id, start_frame in enumerate(range(first_frame, last_frame, segment_frames)):
+            TASKS.append({'id': task_id, 'start_frame': start_frame, 'end_frame': min(start_frame + segment_frames, last_frame), 'attempts': 0, 'running': {}, 'segment_path': None})
+
+
+def is_finished() -> bool:
+    return all(task['segment_path'] for task in TASKS) or is_failed()
+
+
+def is_failed() -> bool:
+    return any(not task['segment_path'] and not task['running'] and task['attempts'] >= MAX_ATTEMPTS for task in TASKS)
+
+
+def next_task(worker_name: str) -> Optional[Dict[str, Any]]:
+    with TASK_CONDITION:
+        while not is_finished():
+            for task in TASKS:
+                if not task['segment_path'] and not task['running'] and task['attempts'] < MAX_ATTEMPTS:
+                    return start_task(task, worker_name)
+            # reassign straggling ranges to idle workers
+            if TASK_DURATIONS:
+                straggler_duration = STRAGGLER_FACTOR * statistics.median(TASK_DURATIONS)
+                for task in TASKS:
+                    if not task['segment_path'] and len(task['running']) == 1 and worker_name not in task['running'] and task['attempts'] < MAX_ATTEMPTS and time.time() - min(task['running'].values()) > straggler_duration:
+                        return start_task(task, worker_name)
+            TASK_CONDITION.wait(1)
+    return None
+
+
+def start_task(task: Dict[str, Any], worker_name: str) -> Dict[str, Any]:
+    task['attempts'] += 1
+    task['running'][worker_name] = time.time()
+    return task
+
+
+def finish_task(task: Dict[str, Any], worker_name: str, segment_path: Optional[str]) -> None:
+    with TASK_CONDITION:
+        started = task['running'].pop(worker_name, time.time())
+        if segment_path and not task['segment_path']:
+            task['segment_path'] = segment_path
+            TASK_DURATIONS.append(time.time() - started)
+        elif segment_path and os.path.isfile(segment_path):
+            os.remove(segment_path)
+        if not segment_path and task['attempts'] >= MAX_ATTEMPTS and not task['running']:
+            modules.core.update_status(f"Frames {task['start_frame']}-{task['end_frame']} failed {task['attempts']} times.")
+        TASK_CONDITION.notify_all()
+
+
+def handle_worker(connection: socket.socket, worker_address: Any, task_settings: Dict[str, Any], files: Dict[str, Tuple[str, str]], segment_directory_path: str) -> None:
+    task = None
+    worker_name = str(worker_address)
+    try:
+        hello = receive_message(connection)
+        worker_name = f"{hello.get('name')}@{worker_address}"
+        modules.core.update_status(f'Worker {worker_name} connected.')
+        for kind, (file_path, file_digest) in files.items():
+            send_message(connection, {'type': 'file', 'kind': kind, 'digest': file_digest, 'extension': os.path.splitext(file_path)[1]}, file_path)
+        while True:
+            task = next_task(worker_name)
+            if task is None:
+                break
+            send_message(connection, dict(task_settings, type='task', id=task['id'], start_frame=task['start_frame'], end_frame=task['end_frame']))
+            connection.settimeout(TASK_TIMEOUT)
+            segment_path = os.path.join(segment_directory_path, f"{task['id']:08d}-{task['attempts']}-{threading.get_ident()}.mp4")
+            result = receive_message(connection, segment_path)
+            connection.settimeout(None)
+            if result.get('status') == 'ok' and os.path.isfile(segment_path):
+                finish_task(task, worker_name, segment_path)
+            else:
+                modules.core.update_status(f"Worker {worker_name} failed frames {task['start_frame']}-{task['end_frame']}: {result.get('error')}")
+                finish_task(task, worker_name, None)
+            task = None
+        send_message(connection, {'type': 'close'})
+    except (OSError, ValueError) as exception:
+        modules.core.update_status(f'Worker {worker_name} disconnected: {exception}')
+        if task:
+            finish_task(task, worker_name, None)
+    finally:
+        connection.close()
+
+
+def accept_workers(server: socket.socket, task_settings: Dict[str, Any], files: Dict[str, Tuple[str, str]], segment_directory_path: str) -> None:
+    while True:
+        try:
+            connection, worker_address = server.accept()
+        except OSError:
+            break
+        threading.Thread(target=handle_worker, args=(connection, worker_address, task_settings, files, segment_directory_path), daemon=True).start()
+
+
+def concat_segments(segment_paths: List[str], output_path: str) -> bool:
+    concat_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(concat_path, 'w') as concat_file:
+        for segment_path in segment_paths:
+            concat_file.write(f"file '{os.path.abspath(segment_path)}'\n")
+    return run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', concat_path, '-c', 'copy', '-y', output_path])
+
+
+def run_coordinator() -> None:
+    for frame_processor in get_frame_processors(modules.globals.frame_processors):
+        if not frame_processor.pre_start():
+            return
+    target_path = modules.globals.target_path
+    if modules.globals.nsfw == False:
+        from modules.predicter import predict_video
+        if predict_video(target_path):
+            modules.core.destroy()
+    target_fps = detect_fps(target_path)
+    # counting packets reads the whole target, a closed range does not need it
+    frame_total = modules.globals.end_frame if modules.globals.end_frame is not None else detect_frame_total(target_path)
+    if not frame_total:
+        modules.core.update_status('Could not count the target frames.')
+        return
+    create_temp(target_path)
+    segment_directory_path = os.path.join(get_temp_directory_path(target_path), 'segments')
+    os.makedirs(segment_directory_path, exist_ok=True)
+    first_frame = min(modules.globals.start_frame or 0, frame_total)
+    last_frame = min(modules.globals.end_frame or frame_total, frame_total)
+    create_tasks(first_frame, last_frame, modules.globals.segment_frames)
+    if not TASKS:
+        modules.core.update_status('The frame range is empty.')
+        return
+    task_settings = {name: getattr(modules.globals, name) for name in CLUSTER_SETTINGS}
+    task_settings.update({'target_fps': target_fps, 'fps': target_fps if modules.globals.keep_fps else 30.0, 'source_map_total': len(modules.globals.source_map)})
+    file_paths = [('source', modules.globals.source_path), ('target', target_path)]
+    # mapped sources and references travel to the workers like the source
+    for map_index, (source_path, reference_path) in enumerate(modules.globals.source_map):
+        file_paths.extend([(f'map-source-{map_index}', source_path), (f'map-reference-{map_index}', reference_path)])
+    files = {kind: (file_path, get_file_digest(file_path)) for kind, file_path in file_paths}
+    server = create_server(modules.globals.coordinator)
+    modules.core.update_status(f'Coordinating {len(TASKS)} ranges of {last_frame - first_frame} frames on {modules.globals.coordinator}...')
+    threading.Thread(target=accept_workers, args=(server, task_settings, files, segment_directory_path), daemon=True).start()
+    with TASK_CONDITION:
+        while not is_finished():
+            TASK_CONDITION.wait(1)
+        failed = is_failed()
+    server.close()
+    if failed or not concat_segments([task['segment_path'] for task in TASKS], get_temp_output_path(target_path)):
+        modules.core.update_status('Processing to video failed!')
+        clean_temp(target_path)
+        return
+    modules.core.restore_target(modules.globals)
+
+
+def process_task(task: Dict[str, Any], files: Dict[str, str], cache_directory_path: str) -> str:
+    for name in CLUSTER_SETTINGS:
+        setattr(modules.globals, name, task[name])
+    modules.globals.source_path = files['source']
+    modules.globals.target_path = files['target']
+    modules.globals.source_map = [[files[f'map-source-{map_index}'], files[f'map-reference-{map_index}']] for map_index in range(task['source_map_total'])]
+    modules.globals.detection_index = False
+    frame_processors = get_frame_processors(modules.globals.frame_processors)
+    for frame_processor in frame_processors:
+        if not frame_processor.pre_check() or not frame_processor.pre_start():
+            raise RuntimeError(f'{frame_processor.NAME} is not ready')
+    segment_path = os.path.join(cache_directory_path, f"segment-{task['id']:08d}.mp4")
+    with tempfile.TemporaryDirectory(dir=cache_directory_path) as task_directory_path:
+        frame_format = os.path.join(task_directory_path, TEMP_FRAME_FORMAT)
+        if not run_ffmpeg(['-ss', str(task['start_frame'] / task['target_fps']), '-i', files['target'], '-frames:v', str(task['end_frame'] - task['start_frame']), '-pix_fmt', 'rgb24', frame_format]):
+            raise RuntimeError('Extracting frames failed')
+        temp_frame_paths = sorted(glob.glob(os.path.join(glob.escape(task_directory_path), '*.png')))
+        process_video(modules.core.get_source_face(), temp_frame_paths, frame_processors)
+        if not run_ffmpeg(['-r', str(task['fps']), '-i', frame_format, '-c:v', task['video_encoder'], '-crf', str(task['video_quality']), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', segment_path]):
+            raise RuntimeError('Creating segment failed')
+    return segment_path
+
+
+def run_worker() -> None:
+    cache_directory_path = tempfile.mkdtemp(prefix='reactor-worker-')
+    connection = connect(modules.globals.worker)
+    files: Dict[str, str] = {}
+    try:
+        send_message(connection, {'type': 'hello', 'name': platform.node(), 'execution_threads': modules.globals.execution_threads})
+        while True:
+            message_path = os.path.join(cache_directory_path, 'message')
+            message = receive_message(connection, message_path)
+            if message['type'] == 'file':
+                file_path = os.path.join(cache_directory_path, message['digest'] + message['extension'])
+                os.replace(message_path, file_path)
+                files[message['kind']] = file_path
+            if message['type'] == 'task':
+                modules.core.update_status(f"Processing frames {message['start_frame']}-{message['end_frame']}...")
+                try:
+                    segment_path = process_task(message, files, cache_directory_path)
+                    send_message(connection, {'type': 'result', 'status': 'ok', 'id': message['id']}, segment_path)
+                    os.remove(segment_path)
+                except Exception as exception:
+                    send_message(connection, {'type': 'result', 'status': 'error', 'id': message['id'], 'error': str(exception)})
+            if message['type'] == 'close':
+                break
+    finally:
+        connection.close()
+        shutil.rmtree(cache_directory_path, ignore_errors=True)
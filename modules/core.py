@@ -6,23 +6,29 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+from typing import Any, List
 import platform
 import signal
 import shutil
 import argparse
-import torch
 import onnxruntime
 import tensorflow
+import cv2
+from pathlib import Path
 
 import modules.globals
 import modules.metadata
 import modules.ui as ui
-from modules.processors.frame.core import get_frame_processors_modules
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
-
-if 'ROCMExecutionProvider' in modules.globals.execution_providers:
-    del torch
+import modules.jobs as jobs
+import modules.autotune as autotune
+import modules.cluster as cluster
+import modules.output_cache as output_cache
+import modules.detection_index as detection_index
+import modules.stream as stream
+import modules.stage_cache as stage_cache
+from modules.face_analyser import get_one_face
+from modules.processors.frame.core import get_frame_processors, set_frame_processors_from_ui, teardown_frame_processors, has_detections, process_batch, process_video, process_images
+from modules.utilities import has_image_extension, is_image, is_image_directory, get_image_paths, is_video, resolve_frame_range, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -32,18 +38,42 @@ def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser()
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
-    program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
+    program.add_argument('-t', '--target', help='select an target image, video or image directory', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
     program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
+    program.add_argument('--map-source', help='swap target faces matching the reference image with the source image', dest='source_map', nargs=2, action='append', default=[], metavar=('SOURCE_PATH', 'REFERENCE_PATH'))
+    program.add_argument('--start-time', help='start of the processed range in seconds', dest='start_time', type=float)
+    program.add_argument('--end-time', help='end of the processed range in seconds', dest='end_time', type=float)
+    program.add_argument('--start-frame', help='first processed frame number', dest='start_frame', type=int)
+    program.add_argument('--end-frame', help='frame number after the processed range', dest='end_frame', type=int)
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
+    program.add_argument('--frame-store', help='keep temporary frames in one memory-mapped raw file', dest='frame_store', action='store_true', default=False)
+    program.add_argument('--temp-directory', help='directory for temporary frames, for example a tmpfs mount', dest='temp_directory')
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-batch-size', help='number of frames per execution task', dest='execution_batch_size', type=int, default=1)
+    program.add_argument('--autotune', help='calibrate execution provider, threads and batch size on the target and save them for this host', dest='autotune', action='store_true', default=False)
+    program.add_argument('--coordinator', help='split the target into frame ranges for workers connecting to HOST:PORT or unix:PATH', dest='coordinator')
+    program.add_argument('--worker', help='process frame ranges for the coordinator at HOST:PORT or unix:PATH', dest='worker')
+    program.add_argument('--segment-frames', help='number of frames per coordinator range', dest='segment_frames', type=int, default=300)
+    program.add_argument('--detection-index', help='reuse target face detections from a sidecar index', dest='detection_index', action='store_true', default=False)
+    program.add_argument('--output-cache', help='reuse outputs of identical jobs', dest='output_cache', action='store_true', default=False)
+    program.add_argument('--cache-directory', help='directory of the output cache', dest='cache_directory')
+    program.add_argument('--cache-size', help='maximum size of the output cache in GB', dest='cache_size', type=int, default=20)
+    program.add_argument('--stage-cache', help='keep decoded and processed frames of every stage to resume reruns at the first changed stage', dest='stage_cache', action='store_true', default=False)
+    program.add_argument('--cache-list', help='list the output cache entries', dest='cache_list', action='store_true', default=False)
+    program.add_argument('--cache-purge', help='remove every output cache entry', dest='cache_purge', action='store_true', default=False)
+    program.add_argument('--stream-input', help='stream frames from a pipe (-), a named fifo or a video file looped as a live source', dest='stream_input')
+    program.add_argument('--stream-output', help='write processed bgr24 frames to a pipe (-) or a named fifo', dest='stream_output', default='-')
+    program.add_argument('--stream-resolution', help='frame size of the stream as WIDTHxHEIGHT, required for pipes and fifos', dest='stream_resolution')
+    program.add_argument('--stream-policy', help='drop late frames or reuse the latest detection for them', dest='stream_policy', default='skip-detection', choices=stream.STREAM_POLICIES)
+    program.add_argument('--latency-budget', help='target end-to-end stream latency in milliseconds', dest='latency_budget', type=int, default=200)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -54,20 +84,46 @@ def parse_args() -> None:
 
     args = program.parse_args()
 
+    if args.source_map and not args.source_path:
+        args.source_path = args.source_map[0][0]
     modules.globals.source_path = args.source_path
+    modules.globals.source_map = args.source_map
     modules.globals.target_path = args.target_path
     modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
-    modules.globals.headless = args.source_path or args.target_path or args.output_path
+    try:
+        modules.globals.start_frame, modules.globals.end_frame = resolve_frame_range(modules.globals.target_path, args.start_time, args.end_time, args.start_frame, args.end_frame)
+    except ValueError as exception:
+        program.error(f'empty frame range, {exception}')
+    modules.globals.headless = args.source_path or args.target_path or args.output_path or args.worker or args.stream_input
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
     modules.globals.many_faces = args.many_faces
     modules.globals.video_encoder = args.video_encoder
     modules.globals.video_quality = args.video_quality
+    modules.globals.frame_store = args.frame_store
+    modules.globals.temp_directory = args.temp_directory
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
     modules.globals.execution_threads = args.execution_threads
+    modules.globals.execution_batch_size = args.execution_batch_size
+    modules.globals.autotune = args.autotune
+    modules.globals.coordinator = args.coordinator
+    modules.globals.worker = args.worker
+    modules.globals.segment_frames = args.segment_frames
+    modules.globals.detection_index = args.detection_index
+    modules.globals.output_cache = args.output_cache
+    modules.globals.cache_directory = args.cache_directory
+    modules.globals.cache_size = args.cache_size
+    modules.globals.stage_cache = args.stage_cache
+    modules.globals.cache_list = args.cache_list
+    modules.globals.cache_purge = args.cache_purge
+    modules.globals.stream_input = args.stream_input
+    modules.globals.stream_output = args.stream_output
+    modules.globals.stream_resolution = args.stream_resolution
+    modules.globals.stream_policy = args.stream_policy
+    modules.globals.latency_budget = args.latency_budget
 
     #for ENHANCER tumbler:
     if 'face_enhancer' in args.frame_processor:
@@ -98,6 +154,16 @@ def parse_args() -> None:
         print('\033[33mArgument --gpu-threads is deprecated. Use --execution-threads instead.\033[0m')
         modules.globals.execution_threads = args.gpu_threads_deprecated
 
+    # load the host profile from a previous --autotune run, explicit arguments win
+    profile = autotune.load_profile()
+    if profile and not args.autotune:
+        autotune.apply_profile(
+            profile,
+            execution_providers=not any(arg.startswith(('--execution-provider', '--gpu-vendor')) for arg in sys.argv),
+            execution_threads=not any(arg.startswith(('--execution-threads', '--cpu-cores', '--gpu-threads')) for arg in sys.argv),
+            execution_batch_size=not any(arg.startswith('--execution-batch-size') for arg in sys.argv)
+        )
+
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
     return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
@@ -146,7 +212,9 @@ def limit_resources() -> None:
 
 
 def release_resources() -> None:
-    if 'CUDAExecutionProvider' in modules.globals.execution_providers:
+    # torch is only loaded to export models, there is nothing to free without it
+    torch = sys.modules.get('torch')
+    if torch and 'CUDAExecutionProvider' in modules.globals.execution_providers:
         torch.cuda.empty_cache()
 
 
@@ -167,60 +235,160 @@ def update_status(message: str, scope: str = 'REACTOR.CORE') -> None:
 
 
 def start() -> None:
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+    if modules.globals.coordinator and is_video(modules.globals.target_path):
+        if not restore_cached_output():
+            cluster.run_coordinator()
+        return
+    if process_target():
+        encode_target()
+
+
+def restore_cached_output() -> bool:
+    set_frame_processors_from_ui(modules.globals.frame_processors)
+    if modules.globals.output_cache and output_cache.restore_output(modules.globals):
+        update_status('Restored output from cache!')
+        return True
+    return False
+
+
+def process_target() -> bool:
+    if restore_cached_output():
+        return False
+    for frame_processor in get_frame_processors(modules.globals.frame_processors):
         if not frame_processor.pre_start():
-            return
+            return False
+    # process image directory to images
+    if is_image_directory(modules.globals.target_path):
+        process_image_directory()
+        return False
     # process image to image
     if has_image_extension(modules.globals.target_path):
         if modules.globals.nsfw == False:
             from modules.predicter import predict_image
             if predict_image(modules.globals.target_path):
                 destroy()
-        shutil.copy2(modules.globals.target_path, modules.globals.output_path)
-        for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-            update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_image(modules.globals.source_path, modules.globals.output_path, modules.globals.output_path)
-            release_resources()
-        if is_image(modules.globals.target_path):
+        # keep the frame in memory through the whole chain and encode once
+        frame_processors = get_frame_processors(modules.globals.frame_processors)
+        update_status('Progressing...', ', '.join(frame_processor.NAME for frame_processor in frame_processors))
+        temp_frame = process_batch(get_source_face(), [cv2.imread(modules.globals.target_path)], frame_processors)[0]
+        teardown_frame_processors(frame_processors)
+        release_resources()
+        cv2.imwrite(modules.globals.output_path, temp_frame)
+        if is_image(modules.globals.output_path):
+            if modules.globals.output_cache:
+                output_cache.store_output(modules.globals)
             update_status('Processing to image succeed!')
         else:
             update_status('Processing to image failed!')
-        return
+        return False
     # process image to videos
     if modules.globals.nsfw == False:
         from modules.predicter import predict_video
         if predict_video(modules.globals.target_path):
             destroy()
+    frame_processors = get_frame_processors(modules.globals.frame_processors)
+    stage_keys = stage_cache.get_stage_keys(frame_processors) if modules.globals.stage_cache else []
+    stage_index = stage_cache.find_stage(stage_keys)
+    # processed stages lost the untouched frames the remaining processors detect on, their faces are kept with the decoded stage
+    if stage_index > 0 and has_detections(frame_processors[stage_index:]):
+        frame_total = stage_cache.load_manifest(stage_keys[stage_index][1])['frame_total']
+        if not stage_cache.load_stage_detections(stage_keys[0][1], frame_total) and not (modules.globals.detection_index and detection_index.load_detection_index(modules.globals.target_path, frame_total)):
+            stage_index = stage_cache.find_stage(stage_keys[:1])
+    # resume after the last cached stage, the processors before it are skipped
+    remaining_frame_processors = frame_processors[max(stage_index, 0):]
     update_status('Creating temp resources...')
     create_temp(modules.globals.target_path)
-    update_status('Extracting frames...')
-    extract_frames(modules.globals.target_path)
-    temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
-        release_resources()
+    if stage_index >= 0:
+        update_status(f'Resuming from cached {stage_keys[stage_index][0]} frames...')
+        temp_frame_paths = stage_cache.restore_stage(stage_keys[stage_index][1], modules.globals.target_path, link=not remaining_frame_processors)
+    else:
+        update_status('Extracting frames...')
+        if not extract_frames(modules.globals.target_path):
+            update_status('Extracting frames failed, check the temp directory free space!')
+            clean_temp(modules.globals.target_path)
+            return False
+        temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        if stage_keys:
+            stage_cache.store_stage(stage_keys[0][1], temp_frame_paths)
+    if not remaining_frame_processors:
+        return True
+    # the detection index and the decoded stage only record faces of untouched frames
+    use_detection_index = (modules.globals.detection_index or bool(stage_keys)) and stage_index <= 0
+    if use_detection_index:
+        if modules.globals.detection_index and detection_index.load_detection_index(modules.globals.target_path, len(temp_frame_paths)):
+            update_status('Loaded target detection index, skipping detection...')
+        elif stage_keys and stage_cache.load_stage_detections(stage_keys[0][1], len(temp_frame_paths)):
+            update_status('Loaded cached stage detections, skipping detection...')
+    pending_stage_keys = stage_keys[max(stage_index, 0) + 1:]
+    stage_cache.begin_stages(remaining_frame_processors, pending_stage_keys)
+    # every frame runs through the whole chain in one pass
+    update_status('Progressing...', ', '.join(frame_processor.NAME for frame_processor in remaining_frame_processors))
+    process_video(get_source_face(), temp_frame_paths, remaining_frame_processors)
+    teardown_frame_processors(remaining_frame_processors)
+    release_resources()
+    stage_cache.end_stages(pending_stage_keys, temp_frame_paths)
+    if use_detection_index:
+        try:
+            if modules.globals.detection_index and detection_index.save_detection_index(modules.globals.target_path, len(temp_frame_paths)):
+                update_status('Saved target detection index...')
+            if stage_keys:
+                stage_cache.save_stage_detections(stage_keys[0][1], len(temp_frame_paths))
+        except OSError as exception:
+            update_status(f'Saving target detection index failed: {exception}')
+    detection_index.clear_detection_index()
+    return True
+
+
+def get_source_face() -> Any:
+    if is_image(modules.globals.source_path):
+        return get_one_face(cv2.imread(modules.globals.source_path))
+    return None
+
+
+def process_image_directory() -> None:
+    target_paths = get_image_paths(modules.globals.target_path)
+    if modules.globals.nsfw == False:
+        from modules.predicter import predict_image
+        target_paths = [target_path for target_path in target_paths if not predict_image(target_path)]
+    Path(modules.globals.output_path).mkdir(parents=True, exist_ok=True)
+    output_paths = [os.path.join(modules.globals.output_path, os.path.basename(target_path)) for target_path in target_paths]
+    update_status(f'Processing {len(target_paths)} images...')
+    frame_processors = get_frame_processors(modules.globals.frame_processors)
+    process_images(get_source_face(), target_paths, output_paths, frame_processors)
+    teardown_frame_processors(frame_processors)
+    release_resources()
+    update_status('Processing to images succeed!')
+
+
+def encode_target(settings: Any = modules.globals) -> None:
+    # settings is modules.globals or a job snapshot so encoding can overlap the next job
     # handles fps
-    if modules.globals.keep_fps:
+    if settings.keep_fps:
         update_status('Detecting fps...')
-        fps = detect_fps(modules.globals.target_path)
+        fps = detect_fps(settings.target_path)
         update_status(f'Creating video with {fps} fps...')
-        create_video(modules.globals.target_path, fps)
+        create_video(settings.target_path, fps, settings.video_encoder, settings.video_quality)
     else:
         update_status('Creating video with 30.0 fps...')
-        create_video(modules.globals.target_path)
+        create_video(settings.target_path, 30.0, settings.video_encoder, settings.video_quality)
+    restore_target(settings)
+
+
+def restore_target(settings: Any = modules.globals) -> None:
     # handle audio
-    if modules.globals.keep_audio:
-        if modules.globals.keep_fps:
+    if settings.keep_audio:
+        if settings.keep_fps:
             update_status('Restoring audio...')
         else:
             update_status('Restoring audio might cause issues as fps are not kept...')
-        restore_audio(modules.globals.target_path, modules.globals.output_path)
+        restore_audio(settings.target_path, settings.output_path, settings.start_frame, settings.end_frame)
     else:
-        move_temp(modules.globals.target_path, modules.globals.output_path)
+        move_temp(settings.target_path, settings.output_path)
     # clean and validate
-    clean_temp(modules.globals.target_path)
-    if is_video(modules.globals.target_path):
+    clean_temp(settings.target_path, settings.keep_frames)
+    if is_video(settings.target_path):
+        if modules.globals.output_cache:
+            output_cache.store_output(settings)
         update_status('Processing to video succeed!')
     else:
         update_status('Processing to video failed!')
@@ -234,14 +402,36 @@ def destroy() -> None:
 
 def run() -> None:
     parse_args()
+    if modules.globals.stream_input:
+        # redirect before the checks download and load models, they print to stdout
+        stream_output_file = stream.open_output(modules.globals.stream_output)
+    if modules.globals.cache_list or modules.globals.cache_purge:
+        if modules.globals.cache_purge:
+            output_cache.purge_entries()
+            stage_cache.purge_stages()
+        output_cache.list_entries()
+        stage_cache.list_stages()
+        return
     if not pre_check():
         return
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+    for frame_processor in get_frame_processors(modules.globals.frame_processors):
         if not frame_processor.pre_check():
             return
     limit_resources()
+    if modules.globals.autotune:
+        autotune.autotune()
+        return
+    if modules.globals.worker:
+        cluster.run_worker()
+        return
+    if modules.globals.stream_input:
+        stream.run_stream(stream_output_file)
+        return
     if modules.globals.headless:
         start()
     else:
-        window = ui.init(start, destroy)
+        # the ui edits its own selection, the worker owns modules.globals while a job runs
+        selection = jobs.snapshot_settings()
+        jobs.JOB_LISTENERS.append(ui.update_job)
+        window = ui.init(lambda: jobs.submit_job(selection), destroy, selection)
         window.mainloop()
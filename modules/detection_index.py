@@ -0,0 +1,117 @@
+import contextlib
+import json
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy
+from insightface.app.common import Face
+
+import modules.globals
+from modules.output_cache import get_file_digest_cached
+
+DETECTION_INDEX_EXTENSION = '.detections.npz'
+ANALYSER_SETTINGS = {'name': 'buffalo_l', 'det_size': [640, 640]}
+
+DETECTIONS: Dict[int, List[Face]] = {}
+RECORDS: Dict[int, Tuple[Any, Any, Any, Any]] = {}
+DETECTION_INDEX_LOADED = False
+FRAME_CONTEXT = threading.local()
+THREAD_LOCK = threading.Lock()
+
+
+def get_detection_index_path(target_path: str) -> str:
+    target_name, _ = os.path.splitext(os.path.basename(target_path))
+    directory_path = modules.globals.temp_directory or os.path.dirname(target_path)
+    return os.path.join(directory_path, target_name + DETECTION_INDEX_EXTENSION)
+
+
+def get_metadata(target_path: str, frame_total: int) -> str:
+    return json.dumps({'target': get_file_digest_cached(target_path), 'start_frame': modules.globals.start_frame, 'frame_total': frame_total, 'analyser': ANALYSER_SETTINGS}, sort_keys=True)
+
+
+def load_detection_index(target_path: str, frame_total: int, detection_index_path: Optional[str] = None) -> bool:
+    global DETECTIONS, DETECTION_INDEX_LOADED
+
+    with THREAD_LOCK:
+        DETECTIONS = {}
+        RECORDS.clear()
+        DETECTION_INDEX_LOADED = False
+    detection_index_path = detection_index_path or get_detection_index_path(target_path)
+    if not os.path.isfile(detection_index_path):
+        return False
+    with numpy.load(detection_index_path) as detection_index:
+        if str(detection_index['metadata']) != get_metadata(target_path, frame_total):
+            return False
+        frame_offsets = detection_index['frame_offsets']
+        bboxes = detection_index['bboxes']
+        kps = detection_index['kps']
+        det_scores = detection_index['det_scores']
+        embeddings = detection_index['embeddings'].astype(numpy.float32)
+    detections = {}
+    for frame_number in range(frame_total):
+        detections[frame_number] = [Face(bbox=bboxes[index], kps=kps[index], det_score=det_scores[index], embedding=embeddings[index]) for index in range(frame_offsets[frame_number], frame_offsets[frame_number + 1])]
+    with THREAD_LOCK:
+        DETECTIONS = detections
+        DETECTION_INDEX_LOADED = True
+    return True
+
+
+def save_detection_index(target_path: str, frame_total: int, detection_index_path: Optional[str] = None) -> bool:
+    with THREAD_LOCK:
+        if DETECTION_INDEX_LOADED or any(frame_number not in RECORDS for frame_number in range(frame_total)):
+            return False
+        records = [RECORDS[frame_number] for frame_number in range(frame_total)]
+    frame_offsets = numpy.concatenate([[0], numpy.cumsum([len(record[0]) for record in records])]).astype(numpy.int32)
+    numpy.savez(
+        detection_index_path or get_detection_index_path(target_path),
+        metadata=numpy.array(get_metadata(target_path, frame_total)),
+        frame_offsets=frame_offsets,
+        bboxes=numpy.concatenate([record[0] for record in records]),
+        kps=numpy.concatenate([record[1] for record in records]),
+        det_scores=numpy.concatenate([record[2] for record in records]),
+        embeddings=numpy.concatenate([record[3] for record in records])
+    )
+    return True
+
+
+def clear_detection_index() -> None:
+    global DETECTIONS, DETECTION_INDEX_LOADED
+
+    with THREAD_LOCK:
+        DETECTIONS = {}
+        RECORDS.clear()
+        DETECTION_INDEX_LOADED = False
+
+
+@contextlib.contextmanager
+def frame_context(frame_number: Optional[int]) -> Iterator[None]:
+    FRAME_CONTEXT.frame_number = frame_number
+    try:
+        yield
+    finally:
+        FRAME_CONTEXT.frame_number = None
+
+
+def get_faces() -> Optional[List[Face]]:
+    frame_number = getattr(FRAME_CONTEXT, 'frame_number', None)
+    if frame_number is None or not DETECTION_INDEX_LOADED:
+        return None
+    return DETECTIONS.get(frame_number)
+
+
+def record_faces(faces: Any) -> None:
+    # only the first detection of a frame sees the untouched target frame, the stage cache keeps them with the decoded stage
+    frame_number = getattr(FRAME_CONTEXT, 'frame_number', None)
+    if frame_number is None or not (modules.globals.detection_index or modules.globals.stage_cache) or DETECTION_INDEX_LOADED:
+        return
+    faces = faces or []
+    # keep compact arrays, not the face objects with their landmarks
+    record = (
+        numpy.array([face.bbox for face in faces], dtype=numpy.float32).reshape(-1, 4),
+        numpy.array([face.kps for face in faces], dtype=numpy.float32).reshape(-1, 5, 2),
+        numpy.array([face.det_score for face in faces], dtype=numpy.float32).reshape(-1),
+        numpy.array([face.normed_embedding for face in faces], dtype=numpy.float16).reshape(-1, 512)
+    )
+    with THREAD_LOCK:
+        if frame_number not in RECORDS:
+            RECORDS[frame_number] = record
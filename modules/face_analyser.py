@@ -2,6 +2,7 @@ from typing import Any
 import insightface
 
 import modules.globals
+import modules.detection_index
 from modules.typing import Frame
 
 FACE_ANALYSER = None
@@ -11,21 +12,34 @@ def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
     if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+        # the detection index is validated against the same settings
+        analyser_settings = modules.detection_index.ANALYSER_SETTINGS
+        FACE_ANALYSER = insightface.app.FaceAnalysis(name=analyser_settings['name'], providers=modules.globals.execution_providers)
+        FACE_ANALYSER.prepare(ctx_id=0, det_size=tuple(analyser_settings['det_size']))
     return FACE_ANALYSER
 
 
+def clear_face_analyser() -> None:
+    global FACE_ANALYSER
+
+    FACE_ANALYSER = None
+
+
 def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+    face = get_many_faces(frame)
     try:
         return min(face, key=lambda x: x.bbox[0])
-    except ValueError:
+    except (ValueError, TypeError):
         return None
 
 
 def get_many_faces(frame: Frame) -> Any:
+    faces = modules.detection_index.get_faces()
+    if faces is not None:
+        return faces
     try:
-        return get_face_analyser().get(frame)
+        faces = get_face_analyser().get(frame)
     except IndexError:
         return None
+    modules.detection_index.record_faces(faces)
+    return faces
@@ -0,0 +1,52 @@
+from typing import Any, Tuple
+import cv2
+import numpy
+
+from modules.typing import Frame
+
+FFHQ_TEMPLATE_512 = numpy.array([
+    [192.98138, 239.94708],
+    [318.90277, 240.1936],
+    [256.63416, 314.01935],
+    [201.26117, 371.41043],
+    [313.08905, 371.15118]
+], dtype=numpy.float32)
+
+
+def warp_face(temp_frame: Frame, kps: Any, template: Any = FFHQ_TEMPLATE_512, crop_size: int = 512) -> Tuple[Frame, Any]:
+    affine_matrix, _ = cv2.estimateAffinePartial2D(numpy.asarray(kps, dtype=numpy.float32), template * crop_size / 512, method=cv2.LMEDS)
+    crop_frame = cv2.warpAffine(temp_frame, affine_matrix, (crop_size, crop_size), borderMode=cv2.BORDER_REPLICATE)
+    return crop_frame, affine_matrix
+
+
+def paste_back(temp_frame: Frame, crop_frame: Frame, affine_matrix: Any) -> Frame:
+    # same masking as INSwapper paste back, limited to the region around the face and blended in place
+    frame_height, frame_width = temp_frame.shape[:2]
+    crop_size = crop_frame.shape[0]
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    corners = numpy.array([[0, 0, 1], [crop_size, 0, 1], [0, crop_size, 1], [crop_size, crop_size, 1]], dtype=numpy.float32)
+    corners = corners @ inverse_matrix.T
+    margin = int(max(numpy.ptp(corners[:, 0]), numpy.ptp(corners[:, 1]))) // 10 + 10
+    left = max(int(numpy.floor(corners[:, 0].min())) - margin, 0)
+    top = max(int(numpy.floor(corners[:, 1].min())) - margin, 0)
+    right = min(int(numpy.ceil(corners[:, 0].max())) + margin + 1, frame_width)
+    bottom = min(int(numpy.ceil(corners[:, 1].max())) + margin + 1, frame_height)
+    if right <= left or bottom <= top:
+        return temp_frame
+    inverse_matrix[:, 2] -= (left, top)
+    region_size = (right - left, bottom - top)
+    crop_region = cv2.warpAffine(crop_frame, inverse_matrix, region_size, borderValue=0.0)
+    region_mask = cv2.warpAffine(numpy.full((crop_size, crop_size), 255, dtype=numpy.float32), inverse_matrix, region_size, borderValue=0.0)
+    region_mask[region_mask > 20] = 255
+    mask_rows, mask_columns = numpy.where(region_mask == 255)
+    if not len(mask_rows):
+        return temp_frame
+    mask_size = int(numpy.sqrt(numpy.ptp(mask_rows) * numpy.ptp(mask_columns)))
+    erode_size = max(mask_size // 10, 10)
+    region_mask = cv2.erode(region_mask, numpy.ones((erode_size, erode_size), numpy.uint8), iterations=1)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    region_mask = cv2.GaussianBlur(region_mask, (blur_size, blur_size), 0)
+    region_mask = (region_mask / 255)[:, :, numpy.newaxis]
+    target_region = temp_frame[top:bottom, left:right]
+    temp_frame[top:bottom, left:right] = (region_mask * crop_region + (1 - region_mask) * target_region.astype(numpy.float32)).astype(numpy.uint8)
+    return temp_frame
@@ -0,0 +1,118 @@
+import threading
+from typing import Any, List, Optional, Tuple
+import cv2
+import numpy
+
+import modules.globals
+from modules.face_analyser import get_one_face
+from modules.typing import Face
+
+SIMILARITY_THRESHOLD = 0.3
+TRACK_IOU_THRESHOLD = 0.5
+TRACK_REVALIDATE = 25
+TRACK_MAX_GAP = 2
+MAX_TRACKS = 64
+
+SOURCE_FACES: List[Face] = []
+REFERENCE_EMBEDDINGS = None
+TRACK_BOXES = numpy.empty((0, 4), dtype=numpy.float32)
+TRACK_SOURCES: List[int] = []
+TRACK_HITS: List[int] = []
+TRACK_FRAMES: List[int] = []
+THREAD_LOCK = threading.Lock()
+
+
+def load_face_map() -> bool:
+    global SOURCE_FACES, REFERENCE_EMBEDDINGS
+
+    source_faces = []
+    reference_embeddings = []
+    for source_path, reference_path in modules.globals.source_map:
+        source_face = get_one_face(cv2.imread(source_path))
+        reference_face = get_one_face(cv2.imread(reference_path))
+        if not source_face or not reference_face:
+            return False
+        source_faces.append(source_face)
+        reference_embeddings.append(reference_face.normed_embedding)
+    with THREAD_LOCK:
+        SOURCE_FACES = source_faces
+        REFERENCE_EMBEDDINGS = numpy.stack(reference_embeddings).astype(numpy.float32)
+    clear_tracks()
+    return True
+
+
+def clear_tracks() -> None:
+    global TRACK_BOXES, TRACK_SOURCES, TRACK_HITS, TRACK_FRAMES
+
+    with THREAD_LOCK:
+        TRACK_BOXES = numpy.empty((0, 4), dtype=numpy.float32)
+        TRACK_SOURCES = []
+        TRACK_HITS = []
+        TRACK_FRAMES = []
+
+
+def calculate_iou(boxes: Any, other_boxes: Any) -> Any:
+    top_left = numpy.maximum(boxes[:, numpy.newaxis, :2], other_boxes[numpy.newaxis, :, :2])
+    bottom_right = numpy.minimum(boxes[:, numpy.newaxis, 2:], other_boxes[numpy.newaxis, :, 2:])
+    intersection = numpy.prod(numpy.clip(bottom_right - top_left, 0, None), axis=2)
+    areas = numpy.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    other_areas = numpy.prod(other_boxes[:, 2:] - other_boxes[:, :2], axis=1)
+    return intersection / (areas[:, numpy.newaxis] + other_areas[numpy.newaxis, :] - intersection + 1e-6)
+
+
+def match_embeddings(target_faces: List[Face]) -> Tuple[Any, Any]:
+    target_embeddings = numpy.stack([target_face.normed_embedding for target_face in target_faces]).astype(numpy.float32)
+    similarities = target_embeddings @ REFERENCE_EMBEDDINGS.T
+    source_indices = numpy.argmax(similarities, axis=1)
+    return source_indices, similarities[numpy.arange(len(target_faces)), source_indices]
+
+
+def match_faces(target_faces: List[Face], frame_number: Optional[int] = None) -> List[Optional[Face]]:
+    global TRACK_BOXES, TRACK_SOURCES, TRACK_HITS, TRACK_FRAMES
+
+    if not target_faces or REFERENCE_EMBEDDINGS is None:
+        return [None] * len(target_faces)
+    # stills and frames without a number have no neighbours to track from
+    if frame_number is None:
+        source_indices, scores = match_embeddings(target_faces)
+        return [SOURCE_FACES[source_index] if score >= SIMILARITY_THRESHOLD else None for source_index, score in zip(source_indices.tolist(), scores.tolist())]
+    target_boxes = numpy.stack([target_face.bbox for target_face in target_faces]).astype(numpy.float32)
+    with THREAD_LOCK:
+        source_indices = numpy.full(len(target_faces), -1)
+        track_indices = numpy.full(len(target_faces), -1)
+        unmatched = []
+        if len(TRACK_SOURCES):
+            overlaps = calculate_iou(target_boxes, TRACK_BOXES)
+            # only tracks seen in adjacent frames count, threads finish frames slightly out of order
+            overlaps[:, numpy.abs(numpy.array(TRACK_FRAMES) - frame_number) > TRACK_MAX_GAP] = 0
+            best_tracks = numpy.argmax(overlaps, axis=1)
+            for face_index, track_index in enumerate(best_tracks):
+                if overlaps[face_index, track_index] >= TRACK_IOU_THRESHOLD:
+                    track_indices[face_index] = track_index
+                    TRACK_BOXES[track_index] = target_boxes[face_index]
+                    TRACK_FRAMES[track_index] = max(TRACK_FRAMES[track_index], frame_number)
+                    if TRACK_HITS[track_index] < TRACK_REVALIDATE:
+                        source_indices[face_index] = TRACK_SOURCES[track_index]
+                        TRACK_HITS[track_index] += 1
+                        continue
+                unmatched.append(face_index)
+        else:
+            unmatched = list(range(len(target_faces)))
+        if unmatched:
+            matched_indices, scores = match_embeddings([target_faces[face_index] for face_index in unmatched])
+            matched_indices[scores < SIMILARITY_THRESHOLD] = -1
+            new_tracks = []
+            for face_index, source_index in zip(unmatched, matched_indices.tolist()):
+                source_indices[face_index] = source_index
+                track_index = track_indices[face_index]
+                if track_index >= 0:
+                    TRACK_SOURCES[track_index] = source_index
+                    TRACK_HITS[track_index] = 0
+                else:
+                    new_tracks.append(face_index)
+            # start new tracks, dropping the oldest ones
+            TRACK_BOXES = numpy.concatenate([TRACK_BOXES, target_boxes[new_tracks]])[-MAX_TRACKS:]
+            TRACK_SOURCES = (TRACK_SOURCES + source_indices[new_tracks].tolist())[-MAX_TRACKS:]
+            TRACK_HITS = (TRACK_HITS + [0] * len(new_tracks))[-MAX_TRACKS:]
+            TRACK_FRAMES = (TRACK_FRAMES + [frame_number] * len(new_tracks))[-MAX_TRACKS:]
+        return [SOURCE_FACES[source_index] if source_index >= 0 else None for source_index in source_indices]
@@ -0,0 +1,92 @@
+import os
+import shutil
+import struct
+import threading
+from typing import Dict, List, Tuple
+import numpy
+
+FRAME_STORE_FILE = 'frames.raw'
+FRAME_STORE_MAGIC = b'RFS1'
+FRAME_STORE_HEADER = struct.Struct('<4sIIII')
+# page aligned so every frame view maps without copying
+FRAME_STORE_HEADER_SIZE = 4096
+FRAME_STORE_SEPARATOR = '::'
+FRAME_STORES: Dict[str, numpy.memmap] = {}
+THREAD_LOCK = threading.Lock()
+
+
+def get_frame_store_size(frame_total: int, height: int, width: int) -> int:
+    return FRAME_STORE_HEADER_SIZE + frame_total * height * width * 3
+
+
+def has_free_space(directory_path: str, frame_total: int, height: int, width: int) -> bool:
+    return shutil.disk_usage(directory_path).free > get_frame_store_size(frame_total, height, width)
+
+
+def write_header(store_path: str, frame_total: int, height: int, width: int) -> None:
+    with open(store_path, 'r+b') as store_file:
+        store_file.write(FRAME_STORE_HEADER.pack(FRAME_STORE_MAGIC, frame_total, height, width, 3))
+
+
+def read_header(store_path: str) -> Tuple[int, int, int]:
+    with open(store_path, 'rb') as store_file:
+        magic, frame_total, height, width, _ = FRAME_STORE_HEADER.unpack(store_file.read(FRAME_STORE_HEADER.size))
+    if magic != FRAME_STORE_MAGIC:
+        raise ValueError(f'{store_path} is not a frame store')
+    return frame_total, height, width
+
+
+def create_frame_store(store_path: str, frame_total: int, height: int, width: int) -> numpy.memmap:
+    close_frame_store(store_path)
+    with open(store_path, 'wb') as store_file:
+        store_file.truncate(get_frame_store_size(frame_total, height, width))
+    write_header(store_path, frame_total, height, width)
+    return open_frame_store(store_path)
+
+
+def open_frame_store(store_path: str) -> numpy.memmap:
+    with THREAD_LOCK:
+        if store_path not in FRAME_STORES:
+            frame_total, height, width = read_header(store_path)
+            FRAME_STORES[store_path] = numpy.memmap(store_path, dtype=numpy.uint8, mode='r+', offset=FRAME_STORE_HEADER_SIZE, shape=(frame_total, height, width, 3))
+        return FRAME_STORES[store_path]
+
+
+def close_frame_store(store_path: str) -> None:
+    with THREAD_LOCK:
+        store = FRAME_STORES.pop(store_path, None)
+    if store is not None:
+        store.flush()
+        del store
+
+
+def truncate_frame_store(store_path: str, frame_total: int) -> None:
+    _, height, width = read_header(store_path)
+    close_frame_store(store_path)
+    os.truncate(store_path, get_frame_store_size(frame_total, height, width))
+    write_header(store_path, frame_total, height, width)
+
+
+def get_frame_references(store_path: str) -> List[str]:
+    frame_total, _, _ = read_header(store_path)
+    return [f'{store_path}{FRAME_STORE_SEPARATOR}{frame_number}' for frame_number in range(frame_total)]
+
+
+def is_frame_reference(frame_path: str) -> bool:
+    store_path, separator, frame_number = frame_path.rpartition(FRAME_STORE_SEPARATOR)
+    return bool(separator) and store_path.endswith(FRAME_STORE_FILE) and frame_number.isdigit()
+
+
+def parse_frame_reference(frame_path: str) -> Tuple[str, int]:
+    store_path, _, frame_number = frame_path.rpartition(FRAME_STORE_SEPARATOR)
+    return store_path, int(frame_number)
+
+
+def read_frame(frame_path: str) -> numpy.ndarray:
+    store_path, frame_number = parse_frame_reference(frame_path)
+    return open_frame_store(store_path)[frame_number]
+
+
+def write_frame(frame_path: str, frame: numpy.ndarray) -> None:
+    store_path, frame_number = parse_frame_reference(frame_path)
+    open_frame_store(store_path)[frame_number] = frame
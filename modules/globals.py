@@ -10,18 +10,40 @@ file_types = [
 ]
 
 source_path = None
+source_map: List[List[str]] = []
 target_path = None
 output_path = None
 frame_processors: List[str] = []
+start_frame = None
+end_frame = None
 keep_fps = None
 keep_audio = None
 keep_frames = None
 many_faces = None
 video_encoder = None
 video_quality = None
+frame_store = None
+temp_directory = None
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = None
+execution_batch_size = None
+autotune = None
+coordinator = None
+worker = None
+segment_frames = None
+detection_index = None
+output_cache = None
+cache_directory = None
+cache_size = None
+stage_cache = None
+cache_list = None
+cache_purge = None
+stream_input = None
+stream_output = None
+stream_resolution = None
+stream_policy = None
+latency_budget = None
 headless = None
 log_level = 'error'
 fp_ui: Dict[str, bool] = {}
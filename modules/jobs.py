@@ -0,0 +1,128 @@
+import copy
+import queue
+import threading
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+import modules.core
+import modules.globals
+import modules.processors.frame.core
+
+JOB_ATTRIBUTES = [
+    'source_path',
+    'source_map',
+    'target_path',
+    'output_path',
+    'frame_processors',
+    'start_frame',
+    'end_frame',
+    'keep_fps',
+    'keep_audio',
+    'keep_frames',
+    'many_faces',
+    'video_encoder',
+    'video_quality',
+    'fp_ui',
+    'nsfw'
+]
+JOB_QUEUE: 'queue.Queue[Job]' = queue.Queue()
+ENCODE_QUEUE: 'queue.Queue[Job]' = queue.Queue()
+JOB_LISTENERS: List[Callable[[Dict[str, Any]], None]] = []
+JOBS: List['Job'] = []
+CURRENT_JOB: Optional['Job'] = None
+THREAD_LOCK = threading.Lock()
+WORKER_THREADS: List[threading.Thread] = []
+
+
+class Job:
+    def __init__(self, job_id: int, settings: Any = modules.globals) -> None:
+        self.id = job_id
+        self.status = 'queued'
+        self.stage = None
+        for attribute in JOB_ATTRIBUTES:
+            setattr(self, attribute, copy.deepcopy(getattr(settings, attribute)))
+        # the output cache keys on the resolved chain, not on the tumblers
+        modules.processors.frame.core.set_frame_processors_from_ui(self.frame_processors, self.fp_ui)
+
+    def apply(self) -> None:
+        for attribute in JOB_ATTRIBUTES:
+            setattr(modules.globals, attribute, copy.deepcopy(getattr(self, attribute)))
+
+
+def snapshot_settings(settings: Any = modules.globals) -> SimpleNamespace:
+    return SimpleNamespace(**{attribute: copy.deepcopy(getattr(settings, attribute)) for attribute in JOB_ATTRIBUTES})
+
+
+def submit_job(settings: Any = modules.globals) -> Job:
+    with THREAD_LOCK:
+        job = Job(len(JOBS) + 1, settings)
+        JOBS.append(job)
+        if not WORKER_THREADS:
+            modules.processors.frame.core.PROGRESS_LISTENERS.append(report_progress)
+            for worker in [process_worker, encode_worker]:
+                thread = threading.Thread(target=worker, daemon=True)
+                thread.start()
+                WORKER_THREADS.append(thread)
+    JOB_QUEUE.put(job)
+    emit(job, 'queued')
+    return job
+
+
+def get_pending_jobs() -> List[Job]:
+    return [job for job in JOBS if job.status in ['queued', 'processing', 'encoding']]
+
+
+def emit(job: Job, status: str, **event: Any) -> None:
+    job.status = status
+    event.update({'job': job.id, 'status': status, 'stage': job.stage, 'target_path': job.target_path, 'pending': len(get_pending_jobs())})
+    for listener in JOB_LISTENERS:
+        listener(event)
+
+
+def report_progress(progress: Dict[str, Any]) -> None:
+    job = CURRENT_JOB
+    if job is None:
+        return
+    rate = progress.get('rate') or 0.0
+    frames = progress.get('n', 0)
+    total = progress.get('total') or 0
+    eta = (total - frames) / rate if rate else None
+    emit(job, job.status, frames=frames, total=total, fps=rate, eta=eta)
+
+
+def process_worker() -> None:
+    global CURRENT_JOB
+
+    while True:
+        job = JOB_QUEUE.get()
+        # the encode stage still owns the temp directory of the same target
+        if any(pending.status == 'encoding' and pending.target_path == job.target_path for pending in JOBS):
+            ENCODE_QUEUE.join()
+        CURRENT_JOB = job
+        job.apply()
+        job.stage = 'processing'
+        emit(job, 'processing')
+        try:
+            if modules.core.process_target():
+                job.stage = 'encoding'
+                emit(job, 'encoding')
+                ENCODE_QUEUE.put(job)
+            else:
+                emit(job, 'done')
+        except (Exception, SystemExit) as exception:
+            print(exception)
+            emit(job, 'failed')
+        CURRENT_JOB = None
+        JOB_QUEUE.task_done()
+
+
+def encode_worker() -> None:
+    while True:
+        job = ENCODE_QUEUE.get()
+        try:
+            modules.core.encode_target(job)
+            emit(job, 'done')
+        except (Exception, SystemExit) as exception:
+            print(exception)
+            emit(job, 'failed')
+        ENCODE_QUEUE.task_done()
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import modules.globals
+from modules.utilities import get_file_digest, resolve_relative_path
+
+CACHE_INDEX_FILE = 'index.json'
+CACHE_OBJECTS_DIRECTORY = 'objects'
+CACHE_SETTINGS = [
+    'frame_processors',
+    'start_frame',
+    'end_frame',
+    'many_faces',
+    'keep_fps',
+    'keep_audio',
+    'video_encoder',
+    'video_quality'
+]
+THREAD_LOCK = threading.Lock()
+
+
+def get_cache_directory_path() -> str:
+    return modules.globals.cache_directory or resolve_relative_path('../cache')
+
+
+def load_index() -> Dict[str, Any]:
+    index_path = os.path.join(get_cache_directory_path(), CACHE_INDEX_FILE)
+    if os.path.isfile(index_path):
+        with open(index_path) as index_file:
+            return json.load(index_file)
+    return {'entries': {}, 'digests': {}}
+
+
+def save_index(index: Dict[str, Any]) -> None:
+    cache_directory_path = get_cache_directory_path()
+    os.makedirs(cache_directory_path, exist_ok=True)
+    index_path = os.path.join(cache_directory_path, CACHE_INDEX_FILE)
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump(index, index_file, indent=4)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def get_cached_digest(index: Dict[str, Any], file_path: str) -> str:
+    # large targets and models are only rehashed when they change
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    cached = index['digests'].get(file_path)
+    if not cached or cached['size'] != file_stat.st_size or cached['mtime'] != file_stat.st_mtime:
+        cached = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'digest': get_file_digest(file_path)}
+        index['digests'][file_path] = cached
+    return cached['digest']
+
+
+def get_file_digest_cached(file_path: str) -> str:
+    with THREAD_LOCK:
+        index = load_index()
+        digest = get_cached_digest(index, file_path)
+        save_index(index)
+    return digest
+
+
+def get_model_paths(settings: Any) -> List[str]:
+    from modules.processors.frame.core import ModuleFrameProcessor, get_frame_processors
+
+    models_directory_path = resolve_relative_path('../models')
+    model_paths = set()
+    # only the models of the chain count, legacy processors do not declare theirs
+    for frame_processor in get_frame_processors(list(settings.frame_processors), {}):
+        if isinstance(frame_processor, ModuleFrameProcessor) and os.path.isdir(models_directory_path):
+            model_paths.update(os.path.join(models_directory_path, file_name) for file_name in os.listdir(models_directory_path))
+        model_paths.update(frame_processor.STAGE_MODELS)
+    return sorted(model_path for model_path in model_paths if os.path.isfile(model_path))
+
+
+def get_cache_key(index: Dict[str, Any], settings: Any) -> Optional[str]:
+    if not settings.target_path or not os.path.isfile(settings.target_path) or not settings.output_path:
+        return None
+    source_paths = [settings.source_path] + [path for paths in settings.source_map for path in paths]
+    key = {
+        'sources': [get_cached_digest(index, source_path) for source_path in source_paths if source_path and os.path.isfile(source_path)],
+        'target': get_cached_digest(index, settings.target_path),
+        'models': [get_cached_digest(index, model_path) for model_path in get_model_paths(settings)],
+        'settings': {name: getattr(settings, name) for name in CACHE_SETTINGS},
+        'extension': os.path.splitext(settings.output_path)[1].lower()
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_object_path(key: str, extension: str) -> str:
+    return os.path.join(get_cache_directory_path(), CACHE_OBJECTS_DIRECTORY, key + extension)
+
+
+def restore_output(settings: Any = modules.globals) -> bool:
+    with THREAD_LOCK:
+        index = load_index()
+        key = get_cache_key(index, settings)
+        entry = index['entries'].get(key) if key else None
+        if entry and os.path.isfile(get_object_path(key, entry['extension'])):
+            shutil.copy2(get_object_path(key, entry['extension']), settings.output_path)
+            entry['last_access'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            save_index(index)
+            return True
+        save_index(index)
+    return False
+
+
+def store_output(settings: Any = modules.globals) -> None:
+    if not settings.output_path or not os.path.isfile(settings.output_path):
+        return
+    with THREAD_LOCK:
+        index = load_index()
+        key = get_cache_key(index, settings)
+        if key:
+            extension = os.path.splitext(settings.output_path)[1].lower()
+            object_path = get_object_path(key, extension)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            shutil.copy2(settings.output_path, object_path)
+            index['entries'][key] = {'extension': extension, 'size': os.path.getsize(object_path), 'target_path': os.path.abspath(settings.target_path), 'created': time.time(), 'last_access': time.time(), 'hits': 0}
+            evict_entries(index)
+        save_index(index)
+
+
+def evict_entries(index: Dict[str, Any]) -> None:
+    max_size = (modules.globals.cache_size or 0) * 1024 ** 3
+    entries = index['entries']
+    # least recently used first
+    for key in sorted(entries, key=lambda key: entries[key]['last_access']):
+        if sum(entry['size'] for entry in entries.values()) <= max_size:
+            break
+        object_path = get_object_path(key, entries[key]['extension'])
+        if os.path.isfile(object_path):
+            os.remove(object_path)
+        del entries[key]
+
+
+def list_entries() -> None:
+    entries = load_index()['entries']
+    for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_access'], reverse=True):
+        print(f"{key[:16]} {entry['size'] / 1024 ** 2:10.1f} MB {entry.get('hits', 0):5d} hits {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_access']))} {entry['target_path']}")
+    print(f"{len(entries)} entries, {sum(entry['size'] for entry in entries.values()) / 1024 ** 3:.2f} GB in {get_cache_directory_path()}")
+
+
+def purge_entries() -> None:
+    with THREAD_LOCK:
+        index = load_index()
+        shutil.rmtree(os.path.join(get_cache_directory_path(), CACHE_OBJECTS_DIRECTORY), ignore_errors=True)
+        index['entries'] = {}
+        save_index(index)
@@ -1,14 +1,23 @@
 import sys
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Dict, Optional
+import cv2
 from tqdm import tqdm
 
 import modules
-import modules.globals                   
+import modules.globals
+import modules.detection_index
+import modules.stage_cache
+from modules.face_analyser import get_many_faces
+from modules.typing import Face, Frame
+from modules.utilities import get_temp_frame_number, read_temp_frame, write_temp_frame
 
-FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+FRAME_PROCESSORS: Dict[str, 'FrameProcessor'] = {}
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
@@ -16,57 +25,233 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_image',
     'process_video'
 ]
+THREAD_SAFETY_LEVELS = [
+    'shared',
+    'serial',
+    'per_thread'
+]
+RESOURCE_TYPES = [
+    'detections',
+    'execution_providers'
+]
+IO_THREADS = min(os.cpu_count() or 1, 8)
+PROGRESS_LISTENERS: List[Callable[[Dict[str, Any]], None]] = []
+THREAD_INSTANCES = threading.local()
+THREAD_INSTANCE_LIST: List['FrameProcessor'] = []
+SERIAL_LOCKS: Dict[int, threading.Lock] = {}
+THREAD_LOCK = threading.Lock()
+
+
+class ProgressBar(tqdm):
+    def update(self, n: float = 1) -> Any:
+        displayed = super().update(n)
+        for listener in PROGRESS_LISTENERS:
+            listener(self.format_dict)
+        return displayed
+
+
+class FrameProcessor(ABC):
+    NAME = 'REACTOR.FRAME-PROCESSOR'
+    # shared: one instance for every thread, serial: one instance used by one thread at a time, per_thread: one instance per thread
+    THREAD_SAFETY = 'shared'
+    # detections: faces of the untouched frame are passed to process_batch, execution_providers: models follow --execution-provider
+    # settings holds the options to process with, the ui preview passes its own selection instead of modules.globals
+    RESOURCES: List[str] = []
+    # globals the output depends on besides the input frames, None keeps the processor out of the stage cache
+    STAGE_SETTINGS: Optional[List[str]] = None
+    # model files the output depends on, a stage is only invalidated by its own models
+    STAGE_MODELS: List[str] = []
+
+    def pre_check(self) -> bool:
+        return True
+
+    def pre_start(self) -> bool:
+        return True
+
+    def setup(self) -> None:
+        pass
+
+    def teardown(self) -> None:
+        pass
+
+    @abstractmethod
+    def process_batch(self, source_face: Face, temp_frames: List[Frame], detections: List[Optional[List[Face]]], frame_numbers: List[Optional[int]], settings: Any = modules.globals) -> List[Frame]:
+        pass
+
 
+class ModuleFrameProcessor(FrameProcessor):
+    # adapter for processors written against the module level interface
+    THREAD_SAFETY = 'serial'
 
-def load_frame_processor_module(frame_processor: str) -> Any:
+    def __init__(self, frame_processor_module: ModuleType) -> None:
+        self.module = frame_processor_module
+        self.NAME = getattr(frame_processor_module, 'NAME', frame_processor_module.__name__)
+
+    def pre_check(self) -> bool:
+        return self.module.pre_check()
+
+    def pre_start(self) -> bool:
+        return self.module.pre_start()
+
+    def process_batch(self, source_face: Face, temp_frames: List[Frame], detections: List[Optional[List[Face]]], frame_numbers: List[Optional[int]], settings: Any = modules.globals) -> List[Frame]:
+        return [self.module.process_frame(source_face, temp_frame) for temp_frame in temp_frames]
+
+
+def load_frame_processor(frame_processor: str) -> FrameProcessor:
     try:
         frame_processor_module = importlib.import_module(f'modules.processors.frame.{frame_processor}')
-        for method_name in FRAME_PROCESSORS_INTERFACE:
-            if not hasattr(frame_processor_module, method_name):
-                sys.exit()
     except ImportError:
         sys.exit()
-    return frame_processor_module
-
+    if hasattr(frame_processor_module, 'FRAME_PROCESSOR'):
+        return frame_processor_module.FRAME_PROCESSOR()
+    for method_name in FRAME_PROCESSORS_INTERFACE:
+        if not hasattr(frame_processor_module, method_name):
+            sys.exit()
+    return ModuleFrameProcessor(frame_processor_module)
 
-def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType]:
-    global FRAME_PROCESSORS_MODULES
 
-    if not FRAME_PROCESSORS_MODULES:
+def get_frame_processors(frame_processors: List[str], fp_ui: Optional[Dict[str, bool]] = None) -> List[FrameProcessor]:
+    set_frame_processors_from_ui(frame_processors, fp_ui)
+    with THREAD_LOCK:
         for frame_processor in frame_processors:
-            frame_processor_module = load_frame_processor_module(frame_processor)
-            FRAME_PROCESSORS_MODULES.append(frame_processor_module)
-    set_frame_processors_modules_from_ui(frame_processors)
-    return FRAME_PROCESSORS_MODULES
-
-def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
-    global FRAME_PROCESSORS_MODULES
-    for frame_processor, state in modules.globals.fp_ui.items():
+            if frame_processor not in FRAME_PROCESSORS:
+                FRAME_PROCESSORS[frame_processor] = load_frame_processor(frame_processor)
+    return [FRAME_PROCESSORS[frame_processor] for frame_processor in frame_processors]
+
+
+def set_frame_processors_from_ui(frame_processors: List[str], fp_ui: Optional[Dict[str, bool]] = None) -> None:
+    for frame_processor, state in (modules.globals.fp_ui if fp_ui is None else fp_ui).items():
         if state == True and frame_processor not in frame_processors:
-            frame_processor_module = load_frame_processor_module(frame_processor)
-            FRAME_PROCESSORS_MODULES.append(frame_processor_module)
-            modules.globals.frame_processors.append(frame_processor)
-        if state == False:
-            frame_processor_module = load_frame_processor_module(frame_processor)
-            try:
-                FRAME_PROCESSORS_MODULES.remove(frame_processor_module)
-                modules.globals.frame_processors.remove(frame_processor)
-            except:
-                pass
-
-def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
+            frame_processors.append(frame_processor)
+        if state == False and frame_processor in frame_processors:
+            frame_processors.remove(frame_processor)
+
+
+def setup_frame_processors(frame_processors: List[FrameProcessor]) -> None:
+    for frame_processor in frame_processors:
+        if frame_processor.THREAD_SAFETY != 'per_thread':
+            frame_processor.setup()
+
+
+def teardown_frame_processors(frame_processors: List[FrameProcessor]) -> None:
+    for frame_processor in frame_processors:
+        frame_processor.teardown()
+    release_thread_instances()
+
+
+def get_thread_instance(frame_processor: FrameProcessor) -> FrameProcessor:
+    if frame_processor.THREAD_SAFETY != 'per_thread':
+        return frame_processor
+    instances = THREAD_INSTANCES.__dict__.setdefault('instances', {})
+    if id(frame_processor) not in instances:
+        instance = type(frame_processor)()
+        instance.setup()
+        instances[id(frame_processor)] = instance
+        with THREAD_LOCK:
+            THREAD_INSTANCE_LIST.append(instance)
+    return instances[id(frame_processor)]
+
+
+def get_serial_lock(frame_processor: FrameProcessor) -> threading.Lock:
+    with THREAD_LOCK:
+        return SERIAL_LOCKS.setdefault(id(frame_processor), threading.Lock())
+
+
+def release_thread_instances() -> None:
+    with THREAD_LOCK:
+        instances = THREAD_INSTANCE_LIST[:]
+        THREAD_INSTANCE_LIST.clear()
+    for instance in instances:
+        instance.teardown()
+    THREAD_INSTANCES.__dict__.clear()
+
+
+def has_detections(frame_processors: List[FrameProcessor]) -> bool:
+    return any('detections' in frame_processor.RESOURCES for frame_processor in frame_processors)
+
+
+def detect_faces(temp_frames: List[Frame], frame_numbers: List[Optional[int]]) -> List[Optional[List[Face]]]:
+    detections = []
+    for temp_frame, frame_number in zip(temp_frames, frame_numbers):
+        with modules.detection_index.frame_context(frame_number):
+            detections.append(get_many_faces(temp_frame) or [])
+    return detections
+
+
+def process_batch(source_face: Face, temp_frames: List[Frame], frame_processors: List[FrameProcessor], frame_numbers: Optional[List[Optional[int]]] = None, detections: Optional[List[Optional[List[Face]]]] = None, settings: Any = modules.globals) -> List[Frame]:
+    if frame_numbers is None:
+        frame_numbers = [None] * len(temp_frames)
+    # detect once on the untouched frames and share the faces with every processor
+    if detections is None and has_detections(frame_processors):
+        detections = detect_faces(temp_frames, frame_numbers)
+    if detections is None:
+        detections = [None] * len(temp_frames)
+    for frame_processor in frame_processors:
+        instance = get_thread_instance(frame_processor)
+        try:
+            if instance.THREAD_SAFETY == 'serial':
+                with get_serial_lock(instance):
+                    temp_frames = instance.process_batch(source_face, temp_frames, detections, frame_numbers, settings)
+            else:
+                temp_frames = instance.process_batch(source_face, temp_frames, detections, frame_numbers, settings)
+            modules.stage_cache.record_frames(frame_processor, frame_numbers, temp_frames)
+        except Exception as exception:
+            print(exception)
+    return temp_frames
+
+
+def process_temp_frames(source_face: Face, temp_frame_paths: List[str], frame_processors: List[FrameProcessor], progress: Any = None) -> None:
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    frame_numbers = [get_temp_frame_number(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    for temp_frame_path, temp_frame in zip(temp_frame_paths, process_batch(source_face, temp_frames, frame_processors, frame_numbers)):
+        write_temp_frame(temp_frame_path, temp_frame)
+    if progress:
+        progress.update(len(temp_frame_paths))
+
+
+def multi_process_frame(source_face: Face, temp_frame_paths: List[str], frame_processors: List[FrameProcessor], progress: Any = None) -> None:
+    batch_size = modules.globals.execution_batch_size or 1
+    setup_frame_processors(frame_processors)
     with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
         futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
+        for index in range(0, len(temp_frame_paths), batch_size):
+            future = executor.submit(process_temp_frames, source_face, temp_frame_paths[index:index + batch_size], frame_processors, progress)
             futures.append(future)
         for future in futures:
             future.result()
+    release_thread_instances()
 
 
-def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+def process_video(source_face: Face, frame_paths: List[str], frame_processors: List[FrameProcessor]) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(frame_paths)
-    with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
-        multi_process_frame(source_path, frame_paths, process_frames, progress)
+    with ProgressBar(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'execution_batch_size': modules.globals.execution_batch_size, 'max_memory': modules.globals.max_memory})
+        multi_process_frame(source_face, frame_paths, frame_processors, progress)
+
+
+def process_image_batch(source_face: Face, target_paths: List[str], output_paths: List[str], frame_processors: List[FrameProcessor], io_executor: ThreadPoolExecutor, progress: Any = None) -> List[Future[bool]]:
+    temp_frames = list(io_executor.map(cv2.imread, target_paths))
+    readable = [index for index, temp_frame in enumerate(temp_frames) if temp_frame is not None]
+    temp_frames = process_batch(source_face, [temp_frames[index] for index in readable], frame_processors)
+    encode_futures = [io_executor.submit(cv2.imwrite, output_paths[index], temp_frame) for index, temp_frame in zip(readable, temp_frames)]
+    if progress:
+        progress.update(len(target_paths))
+    return encode_futures
+
+
+def process_images(source_face: Face, target_paths: List[str], output_paths: List[str], frame_processors: List[FrameProcessor]) -> None:
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    batch_size = modules.globals.execution_batch_size or 1
+    setup_frame_processors(frame_processors)
+    # decode and encode overlap with inference on a separate io pool
+    with ThreadPoolExecutor(max_workers=IO_THREADS) as io_executor, ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
+        with ProgressBar(total=len(target_paths), desc='Processing', unit='image', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+            futures = []
+            for index in range(0, len(target_paths), batch_size):
+                future = executor.submit(process_image_batch, source_face, target_paths[index:index + batch_size], output_paths[index:index + batch_size], frame_processors, io_executor, progress)
+                futures.append(future)
+            for future in futures:
+                for encode_future in future.result():
+                    encode_future.result()
+    release_thread_instances()
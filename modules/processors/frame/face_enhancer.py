@@ -1,75 +1,107 @@
-from typing import Any, List
-import cv2
+from typing import Any, List, Optional
+import os
+import numpy
+import onnxruntime
 import threading
-import gfpgan
 
 import modules.globals
-import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face
+from modules.face_analyser import get_many_faces
+from modules.face_helper import warp_face, paste_back
+from modules.processors.frame.core import FrameProcessor
 from modules.typing import Frame, Face
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_image_directory, is_video
 
-FACE_ENHANCER = None
-THREAD_SEMAPHORE = threading.Semaphore()
-THREAD_LOCK = threading.Lock()
 NAME = 'REACTOR.FACE-ENHANCER'
 
 
-def pre_check() -> bool:
-    download_directory_path = resolve_relative_path('../models')
-    conditional_download(download_directory_path, ['https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth'])
-    return True
-
-
-def pre_start() -> bool:
-    if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
-        update_status('Select an image or video for target path.', NAME)
-        return False
-    return True
-
-
-def get_face_enhancer() -> Any:
-    global FACE_ENHANCER
-
-    with THREAD_LOCK:
-        if FACE_ENHANCER is None:
-            model_path = resolve_relative_path('../models/GFPGANv1.4.pth')
-            # todo: set models path https://github.com/TencentARC/GFPGAN/issues/399
-            FACE_ENHANCER = gfpgan.GFPGANer(model_path=model_path, upscale=1) # type: ignore[attr-defined]
-    return FACE_ENHANCER
-
-
-def enhance_face(temp_frame: Frame) -> Frame:
-    with THREAD_SEMAPHORE:
-        _, _, temp_frame = get_face_enhancer().enhance(
-            temp_frame,
-            paste_back=True
-        )
-    return temp_frame
-
-
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
-    return temp_frame
-
-
-def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(None, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
-        if progress:
-            progress.update(1)
-
-
-def process_image(source_path: str, target_path: str, output_path: str) -> None:
-    target_frame = cv2.imread(target_path)
-    result = process_frame(None, target_frame)
-    cv2.imwrite(output_path, result)
-
-
-def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+def export_face_enhancer(model_path: str, onnx_path: str) -> None:
+    # torch and gfpgan are only needed for the one-time export
+    import torch
+    from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+
+    class FaceEnhancerExport(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.generator = GFPGANv1Clean(out_size=512, num_style_feat=512, channel_multiplier=2, decoder_load_path=None, fix_decoder=False, num_mlp=8, input_is_latent=True, different_w=True, narrow=1, sft_half=True)
+
+        def forward(self, crop_frame: Any) -> Any:
+            return self.generator(crop_frame, return_rgb=False, randomize_noise=False)[0]
+
+    model = FaceEnhancerExport()
+    state = torch.load(model_path, map_location='cpu')
+    model.generator.load_state_dict(state['params_ema'] if 'params_ema' in state else state['params'], strict=True)
+    model.eval()
+    # the modulated convolutions trace their groups from the batch, so the graph is only valid for one face
+    with torch.no_grad():
+        torch.onnx.export(model, torch.zeros(1, 3, 512, 512), onnx_path + '.tmp', input_names=['input'], output_names=['output'], opset_version=11)
+    os.replace(onnx_path + '.tmp', onnx_path)
+
+
+class FaceEnhancer(FrameProcessor):
+    NAME = NAME
+    THREAD_SAFETY = 'shared'
+    RESOURCES = ['detections', 'execution_providers']
+    STAGE_SETTINGS: List[str] = []
+    STAGE_MODELS = [resolve_relative_path('../models/GFPGANv1.4.onnx')]
+
+    def __init__(self) -> None:
+        self.face_enhancer: Any = None
+        self.lock = threading.Lock()
+
+    def pre_check(self) -> bool:
+        download_directory_path = resolve_relative_path('../models')
+        conditional_download(download_directory_path, ['https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth'])
+        if not os.path.isfile(resolve_relative_path('../models/GFPGANv1.4.onnx')):
+            update_status('Exporting GFPGANv1.4 to ONNX once...', NAME)
+            try:
+                export_face_enhancer(resolve_relative_path('../models/GFPGANv1.4.pth'), resolve_relative_path('../models/GFPGANv1.4.onnx'))
+            except ImportError:
+                update_status('Exporting GFPGANv1.4 requires torch and gfpgan.', NAME)
+                return False
+        return True
+
+    def pre_start(self) -> bool:
+        if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path) and not is_image_directory(modules.globals.target_path):
+            update_status('Select an image, video or image directory for target path.', NAME)
+            return False
+        return True
+
+    def setup(self) -> None:
+        with self.lock:
+            if self.face_enhancer is None:
+                model_path = resolve_relative_path('../models/GFPGANv1.4.onnx')
+                self.face_enhancer = onnxruntime.InferenceSession(model_path, providers=modules.globals.execution_providers)
+
+    def teardown(self) -> None:
+        with self.lock:
+            self.face_enhancer = None
+
+    def enhance_crop_frames(self, crop_frames: List[Frame]) -> List[Frame]:
+        self.setup()
+        crop_batch = numpy.stack(crop_frames)[:, :, :, ::-1].astype(numpy.float32) / 127.5 - 1
+        crop_batch = numpy.ascontiguousarray(crop_batch.transpose(0, 3, 1, 2))
+        # one face per run, models exported with a batch axis are only correct for a batch of one as well
+        crop_batch = numpy.concatenate([self.face_enhancer.run(None, {'input': crop_batch[index:index + 1]})[0] for index in range(len(crop_batch))])
+        crop_batch = ((numpy.clip(crop_batch, -1, 1) + 1) * 127.5).round().astype(numpy.uint8)
+        return [numpy.ascontiguousarray(crop_frame.transpose(1, 2, 0)[:, :, ::-1]) for crop_frame in crop_batch]
+
+    def process_frame(self, source_face: Face, temp_frame: Frame, target_faces: Optional[List[Face]] = None) -> Frame:
+        return self.process_batch(source_face, [temp_frame], [target_faces], [None])[0]
+
+    def process_batch(self, source_face: Face, temp_frames: List[Frame], detections: List[Optional[List[Face]]], frame_numbers: List[Optional[int]], settings: Any = modules.globals) -> List[Frame]:
+        crops = []
+        for frame_index, temp_frame in enumerate(temp_frames):
+            target_faces = detections[frame_index] if detections[frame_index] is not None else get_many_faces(temp_frame)
+            for target_face in target_faces or []:
+                crop_frame, affine_matrix = warp_face(temp_frame, target_face.kps)
+                crops.append((frame_index, crop_frame, affine_matrix))
+        # every face of the batch is prepared and pasted together, the model runs them one by one
+        if crops:
+            enhanced_crop_frames = self.enhance_crop_frames([crop_frame for _, crop_frame, _ in crops])
+            for (frame_index, _, affine_matrix), crop_frame in zip(crops, enhanced_crop_frames):
+                temp_frames[frame_index] = paste_back(temp_frames[frame_index], crop_frame, affine_matrix)
+        return temp_frames
+
+
+FRAME_PROCESSOR = FaceEnhancer
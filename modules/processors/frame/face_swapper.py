@@ -1,86 +1,85 @@
-from typing import Any, List
+from typing import Any, List, Optional
 import cv2
 import insightface
 import threading
 
 import modules.globals
-import modules.processors.frame.core
+import modules.face_map
 from modules.core import update_status
 from modules.face_analyser import get_one_face, get_many_faces
+from modules.face_helper import paste_back
+from modules.processors.frame.core import FrameProcessor
 from modules.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_image_directory, is_video
 
-FACE_SWAPPER = None
-THREAD_LOCK = threading.Lock()
 NAME = 'REACTOR.FACE-SWAPPER'
 
 
-def pre_check() -> bool:
-    download_directory_path = resolve_relative_path('../models')
-    conditional_download(download_directory_path, ['https://github.com/facefusion/facefusion-assets/releases/download/models/inswapper_128.onnx'])
-    return True
-
-
-def pre_start() -> bool:
-    if not is_image(modules.globals.source_path):
-        update_status('Select an image for source path.', NAME)
-        return False
-    elif not get_one_face(cv2.imread(modules.globals.source_path)):
-        update_status('No face in source path detected.', NAME)
-        return False
-    if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
-        update_status('Select an image or video for target path.', NAME)
-        return False
-    return True
-
-
-def get_face_swapper() -> Any:
-    global FACE_SWAPPER
-
-    with THREAD_LOCK:
-        if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
-    return FACE_SWAPPER
-
-
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
-
-
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    if modules.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
-        if many_faces:
-            for target_face in many_faces:
-                temp_frame = swap_face(source_face, target_face, temp_frame)
-    else:
-        target_face = get_one_face(temp_frame)
-        if target_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
-    return temp_frame
-
-
-def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        try:
-            result = process_frame(source_face, temp_frame)
-            cv2.imwrite(temp_frame_path, result)
-        except Exception as exception:
-            print(exception)
-            pass
-        if progress:
-            progress.update(1)
-
-
-def process_image(source_path: str, target_path: str, output_path: str) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
-    target_frame = cv2.imread(target_path)
-    result = process_frame(source_face, target_frame)
-    cv2.imwrite(output_path, result)
-
-
-def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    modules.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames)
+class FaceSwapper(FrameProcessor):
+    NAME = NAME
+    THREAD_SAFETY = 'shared'
+    RESOURCES = ['detections', 'execution_providers']
+    STAGE_SETTINGS = ['source_path', 'source_map', 'many_faces']
+    STAGE_MODELS = [resolve_relative_path('../models/inswapper_128.onnx')]
+
+    def __init__(self) -> None:
+        self.face_swapper: Any = None
+        self.lock = threading.Lock()
+
+    def pre_check(self) -> bool:
+        download_directory_path = resolve_relative_path('../models')
+        conditional_download(download_directory_path, ['https://github.com/facefusion/facefusion-assets/releases/download/models/inswapper_128.onnx'])
+        return True
+
+    def pre_start(self) -> bool:
+        if modules.globals.source_map and not modules.face_map.load_face_map():
+            update_status('No face in mapped source or reference path detected.', NAME)
+            return False
+        if not is_image(modules.globals.source_path):
+            update_status('Select an image for source path.', NAME)
+            return False
+        elif not get_one_face(cv2.imread(modules.globals.source_path)):
+            update_status('No face in source path detected.', NAME)
+            return False
+        if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path) and not is_image_directory(modules.globals.target_path):
+            update_status('Select an image, video or image directory for target path.', NAME)
+            return False
+        return True
+
+    def setup(self) -> None:
+        with self.lock:
+            if self.face_swapper is None:
+                model_path = resolve_relative_path('../models/inswapper_128.onnx')
+                self.face_swapper = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
+
+    def teardown(self) -> None:
+        with self.lock:
+            self.face_swapper = None
+
+    def swap_face(self, source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+        self.setup()
+        swapped_face, affine_matrix = self.face_swapper.get(temp_frame, target_face, source_face, paste_back=False)
+        return paste_back(temp_frame, swapped_face, affine_matrix)
+
+    def process_frame(self, source_face: Face, temp_frame: Frame, target_faces: Optional[List[Face]] = None, frame_number: Optional[int] = None, settings: Any = modules.globals) -> Frame:
+        if target_faces is None:
+            target_faces = get_many_faces(temp_frame)
+        if not target_faces:
+            return temp_frame
+        if settings.source_map:
+            for target_face, mapped_source_face in zip(target_faces, modules.face_map.match_faces(target_faces, frame_number)):
+                if mapped_source_face:
+                    temp_frame = self.swap_face(mapped_source_face, target_face, temp_frame)
+        elif settings.many_faces:
+            for target_face in target_faces:
+                temp_frame = self.swap_face(source_face, target_face, temp_frame)
+        else:
+            target_face = min(target_faces, key=lambda x: x.bbox[0])
+            temp_frame = self.swap_face(source_face, target_face, temp_frame)
+        return temp_frame
+
+    def process_batch(self, source_face: Face, temp_frames: List[Frame], detections: List[Optional[List[Face]]], frame_numbers: List[Optional[int]], settings: Any = modules.globals) -> List[Frame]:
+        return [self.process_frame(source_face, temp_frame, target_faces, frame_number, settings) for temp_frame, target_faces, frame_number in zip(temp_frames, detections, frame_numbers)]
+
+
+FRAME_PROCESSOR = FaceSwapper
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import cv2
+
+import modules.globals
+import modules.detection_index as detection_index
+import modules.frame_store as frame_store
+import modules.output_cache as output_cache
+from modules.typing import Frame
+from modules.utilities import TEMP_FRAME_FORMAT, get_temp_directory_path, get_temp_frame_paths, get_frame_store_path, read_temp_frame
+
+STAGE_DIRECTORY = 'stages'
+STAGE_MANIFEST_FILE = 'stage.json'
+STAGE_DECODED = 'decoded'
+STAGE_DETECTIONS_FILE = 'detections.npz'
+
+STAGE_PATHS: Dict[int, str] = {}
+THREAD_LOCK = threading.Lock()
+
+
+def get_stage_directory_path(key: str) -> str:
+    return os.path.join(output_cache.get_cache_directory_path(), STAGE_DIRECTORY, key)
+
+
+def get_stage_frame_path(stage_directory_path: str, frame_number: int) -> str:
+    return os.path.join(stage_directory_path, TEMP_FRAME_FORMAT % (frame_number + 1))
+
+
+def get_stage_detections_path(key: str) -> str:
+    return os.path.join(get_stage_directory_path(key), STAGE_DETECTIONS_FILE)
+
+
+def get_setting_digest(index: Dict[str, Any], value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        return [get_setting_digest(index, item) for item in value]
+    if isinstance(value, str) and os.path.isfile(value):
+        return output_cache.get_cached_digest(index, value)
+    return value
+
+
+def get_stage_keys(frame_processors: List[Any]) -> List[Tuple[str, str]]:
+    with output_cache.THREAD_LOCK:
+        index = output_cache.load_index()
+        key = hashlib.sha256(json.dumps({
+            'target': output_cache.get_cached_digest(index, modules.globals.target_path),
+            'start_frame': modules.globals.start_frame,
+            'end_frame': modules.globals.end_frame
+        }, sort_keys=True).encode()).hexdigest()
+        stage_keys = [(STAGE_DECODED, key)]
+        # every stage is keyed by the stage before it, so a change invalidates everything after it
+        for frame_processor in frame_processors:
+            if frame_processor.STAGE_SETTINGS is None:
+                break
+            key = hashlib.sha256(json.dumps({
+                'previous': key,
+                'name': frame_processor.NAME,
+                'models': [output_cache.get_cached_digest(index, model_path) for model_path in frame_processor.STAGE_MODELS if os.path.isfile(model_path)],
+                # detections always come from the untouched frames, see process_target
+                'analyser': detection_index.ANALYSER_SETTINGS if 'detections' in frame_processor.RESOURCES else None,
+                'settings': {name: get_setting_digest(index, getattr(modules.globals, name)) for name in frame_processor.STAGE_SETTINGS}
+            }, sort_keys=True).encode()).hexdigest()
+            stage_keys.append((frame_processor.NAME, key))
+        output_cache.save_index(index)
+    return stage_keys
+
+
+def load_manifest(key: str) -> Optional[Dict[str, Any]]:
+    manifest_path = os.path.join(get_stage_directory_path(key), STAGE_MANIFEST_FILE)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    return None
+
+
+def save_manifest(key: str, manifest: Dict[str, Any]) -> None:
+    manifest_path = os.path.join(get_stage_directory_path(key), STAGE_MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def find_stage(stage_keys: List[Tuple[str, str]]) -> int:
+    for stage_index in reversed(range(len(stage_keys))):
+        if load_manifest(stage_keys[stage_index][1]):
+            return stage_index
+    return -1
+
+
+def restore_stage(key: str, target_path: str, link: bool = False) -> List[str]:
+    manifest = load_manifest(key)
+    stage_directory_path = get_stage_directory_path(key)
+    if modules.globals.frame_store:
+        store_path = get_frame_store_path(target_path)
+        frame_store.create_frame_store(store_path, manifest['frame_total'], manifest['height'], manifest['width'])
+        for frame_number, temp_frame_path in enumerate(frame_store.get_frame_references(store_path)):
+            frame_store.write_frame(temp_frame_path, cv2.imread(get_stage_frame_path(stage_directory_path, frame_number)))
+    else:
+        temp_directory_path = get_temp_directory_path(target_path)
+        for frame_number in range(manifest['frame_total']):
+            stage_frame_path = get_stage_frame_path(stage_directory_path, frame_number)
+            temp_frame_path = get_stage_frame_path(temp_directory_path, frame_number)
+            # frames that are only encoded are linked, frames processed in place are copied
+            if link:
+                try:
+                    os.link(stage_frame_path, temp_frame_path)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(stage_frame_path, temp_frame_path)
+    manifest['last_access'] = time.time()
+    save_manifest(key, manifest)
+    return get_temp_frame_paths(target_path)
+
+
+def store_stage(key: str, temp_frame_paths: List[str]) -> None:
+    if not temp_frame_paths:
+        return
+    stage_directory_path = get_stage_directory_path(key)
+    shutil.rmtree(stage_directory_path, ignore_errors=True)
+    os.makedirs(stage_directory_path)
+    for frame_number, temp_frame_path in enumerate(temp_frame_paths):
+        if frame_store.is_frame_reference(temp_frame_path):
+            cv2.imwrite(get_stage_frame_path(stage_directory_path, frame_number), read_temp_frame(temp_frame_path))
+        else:
+            shutil.copy2(temp_frame_path, get_stage_frame_path(stage_directory_path, frame_number))
+    finish_stage(key, len(temp_frame_paths), read_temp_frame(temp_frame_paths[0]))
+
+
+def load_stage_detections(key: str, frame_total: int) -> bool:
+    return detection_index.load_detection_index(modules.globals.target_path, frame_total, get_stage_detections_path(key))
+
+
+def save_stage_detections(key: str, frame_total: int) -> bool:
+    manifest = load_manifest(key)
+    if not manifest:
+        return False
+    detections_path = get_stage_detections_path(key)
+    if not detection_index.save_detection_index(modules.globals.target_path, frame_total, detections_path):
+        return False
+    manifest['size'] += os.path.getsize(detections_path)
+    save_manifest(key, manifest)
+    return True
+
+
+def begin_stages(frame_processors: List[Any], stage_keys: List[Tuple[str, str]]) -> None:
+    with THREAD_LOCK:
+        STAGE_PATHS.clear()
+        for frame_processor, (_, key) in zip(frame_processors, stage_keys):
+            stage_directory_path = get_stage_directory_path(key)
+            shutil.rmtree(stage_directory_path, ignore_errors=True)
+            os.makedirs(stage_directory_path)
+            STAGE_PATHS[id(frame_processor)] = stage_directory_path
+
+
+def record_frames(frame_processor: Any, frame_numbers: List[Optional[int]], temp_frames: List[Frame]) -> None:
+    stage_directory_path = STAGE_PATHS.get(id(frame_processor))
+    if not stage_directory_path:
+        return
+    for frame_number, temp_frame in zip(frame_numbers, temp_frames):
+        if frame_number is not None:
+            cv2.imwrite(get_stage_frame_path(stage_directory_path, frame_number), temp_frame)
+
+
+def end_stages(stage_keys: List[Tuple[str, str]], temp_frame_paths: List[str]) -> None:
+    with THREAD_LOCK:
+        STAGE_PATHS.clear()
+    if not stage_keys or not temp_frame_paths:
+        return
+    temp_frame = read_temp_frame(temp_frame_paths[0])
+    for _, key in stage_keys:
+        finish_stage(key, len(temp_frame_paths), temp_frame)
+
+
+def finish_stage(key: str, frame_total: int, temp_frame: Frame) -> None:
+    stage_directory_path = get_stage_directory_path(key)
+    frame_paths = [os.path.join(stage_directory_path, file_name) for file_name in os.listdir(stage_directory_path)]
+    # a stage missing frames, for example after a failed processor, is never resumed from
+    if len(frame_paths) != frame_total or temp_frame is None:
+        shutil.rmtree(stage_directory_path, ignore_errors=True)
+        return
+    height, width = temp_frame.shape[:2]
+    save_manifest(key, {'target_path': os.path.abspath(modules.globals.target_path), 'frame_total': frame_total, 'height': height, 'width': width, 'size': sum(os.path.getsize(frame_path) for frame_path in frame_paths), 'created': time.time(), 'last_access': time.time()})
+    evict_stages()
+
+
+def get_stages() -> Dict[str, Dict[str, Any]]:
+    stage_directory_path = os.path.join(output_cache.get_cache_directory_path(), STAGE_DIRECTORY)
+    if not os.path.isdir(stage_directory_path):
+        return {}
+    stages = {}
+    for key in os.listdir(stage_directory_path):
+        manifest = load_manifest(key)
+        if manifest:
+            stages[key] = manifest
+    return stages
+
+
+def evict_stages() -> None:
+    max_size = (modules.globals.cache_size or 0) * 1024 ** 3
+    stages = get_stages()
+    # least recently used first
+    for key in sorted(stages, key=lambda key: stages[key]['last_access']):
+        if sum(stage['size'] for stage in stages.values()) <= max_size:
+            break
+        shutil.rmtree(get_stage_directory_path(key), ignore_errors=True)
+        del stages[key]
+
+
+def list_stages() -> None:
+    stages = get_stages()
+    print(f"{len(stages)} stages, {sum(stage['size'] for stage in stages.values()) / 1024 ** 3:.2f} GB in {os.path.join(output_cache.get_cache_directory_path(), STAGE_DIRECTORY)}")
+
+
+def purge_stages() -> None:
+    shutil.rmtree(os.path.join(output_cache.get_cache_directory_path(), STAGE_DIRECTORY), ignore_errors=True)
@@ -0,0 +1,235 @@
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, BinaryIO, Deque, Dict, List, Optional, Tuple
+import cv2
+import numpy
+
+import modules.core
+import modules.globals
+import modules.face_map
+from modules.face_analyser import get_one_face, get_many_faces
+from modules.processors.frame.core import FrameProcessor, get_frame_processors, setup_frame_processors, teardown_frame_processors, has_detections, process_batch
+from modules.typing import Face, Frame
+from modules.utilities import is_image, detect_resolution
+
+STREAM_POLICIES = [
+    'drop',
+    'skip-detection'
+]
+STATS_INTERVAL = 1.0
+NSFW_INTERVAL = 100
+
+STREAM_STATS: Dict[str, int] = {}
+STREAM_LATENCIES: Deque[Tuple[float, float]] = deque()
+STREAM_DETECTIONS: Dict[str, Any] = {}
+STATS_LOCK = threading.Lock()
+STOP_EVENT = threading.Event()
+
+
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    width, height = resolution.lower().split('x')
+    return int(width), int(height)
+
+
+def resolve_resolution(stream_input: str) -> Optional[Tuple[int, int]]:
+    if modules.globals.stream_resolution:
+        return parse_resolution(modules.globals.stream_resolution)
+    # pipes and fifos can not be probed without consuming frames
+    if os.path.isfile(stream_input):
+        return detect_resolution(stream_input)
+    return None
+
+
+def get_decoder_command(stream_input: str, width: int, height: int) -> List[str]:
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level, '-fflags', 'nobuffer', '-flags', 'low_delay']
+    # a regular file stands in for a live source, looped at its native rate
+    if os.path.isfile(stream_input):
+        commands.extend(['-re', '-stream_loop', '-1'])
+    commands.extend(['-i', 'pipe:0' if stream_input == '-' else stream_input, '-vf', f'scale={width}:{height}', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'])
+    return commands
+
+
+def open_output(stream_output: str) -> BinaryIO:
+    if stream_output == '-':
+        sys.stdout.flush()
+        output_file = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', buffering=0)
+        # keep status messages and native library output out of the frame stream
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        sys.stdout = sys.stderr
+        return output_file
+    return open(stream_output, 'wb', buffering=0)
+
+
+def pre_start() -> bool:
+    if modules.globals.source_map and not modules.face_map.load_face_map():
+        modules.core.update_status('No face in mapped source or reference path detected.')
+        return False
+    if not is_image(modules.globals.source_path):
+        modules.core.update_status('Select an image for source path.')
+        return False
+    if not get_one_face(cv2.imread(modules.globals.source_path)):
+        modules.core.update_status('No face in source path detected.')
+        return False
+    return True
+
+
+def count_stat(name: str) -> None:
+    with STATS_LOCK:
+        STREAM_STATS[name] = STREAM_STATS.get(name, 0) + 1
+
+
+def read_exactly(input_file: BinaryIO, size: int) -> Optional[bytearray]:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = input_file.readinto(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+
+def read_frames(decoder: subprocess.Popen, width: int, height: int, frame_queue: queue.Queue, result_queue: queue.Queue) -> None:
+    sequence = 0
+    while not STOP_EVENT.is_set():
+        buffer = read_exactly(decoder.stdout, width * height * 3)
+        if buffer is None:
+            break
+        temp_frame = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, width, 3)
+        # never block the decoder, the oldest waiting frame gives way
+        while True:
+            try:
+                frame_queue.put_nowait((sequence, time.perf_counter(), temp_frame))
+                break
+            except queue.Full:
+                try:
+                    dropped_sequence, captured, _ = frame_queue.get_nowait()
+                    result_queue.put((dropped_sequence, captured, None))
+                    count_stat('dropped')
+                except queue.Empty:
+                    pass
+        sequence += 1
+
+
+def process_frames(source_face: Face, frame_processors: List[FrameProcessor], frame_queue: queue.Queue, result_queue: queue.Queue) -> None:
+    latency_budget = modules.globals.latency_budget / 1000
+    detect = has_detections(frame_processors)
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            break
+        sequence, captured, temp_frame = item
+        if modules.globals.nsfw == False and sequence % NSFW_INTERVAL == 0:
+            from modules.predicter import predict_frame
+            if predict_frame(temp_frame):
+                STOP_EVENT.set()
+        if STOP_EVENT.is_set():
+            result_queue.put((sequence, captured, None))
+            continue
+        lag = time.perf_counter() - captured
+        if modules.globals.stream_policy == 'drop' and lag > latency_budget:
+            result_queue.put((sequence, captured, None))
+            count_stat('dropped')
+            continue
+        detections = None
+        if detect:
+            # late frames reuse the faces of the latest detection
+            if modules.globals.stream_policy == 'skip-detection' and lag > latency_budget / 2 and 'faces' in STREAM_DETECTIONS:
+                detections = [STREAM_DETECTIONS['faces']]
+                count_stat('reused')
+            else:
+                detections = [get_many_faces(temp_frame) or []]
+                STREAM_DETECTIONS['faces'] = detections[0]
+        temp_frame = process_batch(source_face, [temp_frame], frame_processors, [sequence], detections)[0]
+        result_queue.put((sequence, captured, temp_frame))
+
+
+def write_frames(output_file: BinaryIO, result_queue: queue.Queue) -> None:
+    pending: Dict[int, Tuple[float, Optional[Frame]]] = {}
+    next_sequence = 0
+    report_time = time.perf_counter()
+    while True:
+        item = result_queue.get()
+        if item is None:
+            break
+        pending[item[0]] = item[1:]
+        # frames finish out of order across threads but leave in order
+        while next_sequence in pending:
+            captured, temp_frame = pending.pop(next_sequence)
+            next_sequence += 1
+            if temp_frame is None:
+                continue
+            try:
+                output_file.write(memoryview(numpy.ascontiguousarray(temp_frame)))
+            except (BrokenPipeError, OSError):
+                STOP_EVENT.set()
+                return
+            written = time.perf_counter()
+            with STATS_LOCK:
+                STREAM_STATS['frames'] = STREAM_STATS.get('frames', 0) + 1
+                STREAM_LATENCIES.append((written, written - captured))
+                while STREAM_LATENCIES[0][0] < written - STATS_INTERVAL * 5:
+                    STREAM_LATENCIES.popleft()
+        if time.perf_counter() - report_time >= STATS_INTERVAL:
+            report_time = time.perf_counter()
+            report_stats()
+
+
+def report_stats() -> None:
+    with STATS_LOCK:
+        latencies = sorted(latency for _, latency in STREAM_LATENCIES)
+        span = STREAM_LATENCIES[-1][0] - STREAM_LATENCIES[0][0] if len(STREAM_LATENCIES) > 1 else 0
+        stats = dict(STREAM_STATS)
+    if not latencies:
+        return
+    fps = (len(latencies) - 1) / span if span else 0
+    latency = sum(latencies) / len(latencies) * 1000
+    latency_p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+    modules.core.update_status(f"Streaming {fps:.1f} fps, latency {latency:.0f} ms (p95 {latency_p95:.0f} ms), {stats.get('frames', 0)} frames, {stats.get('dropped', 0)} dropped, {stats.get('reused', 0)} reused detections")
+
+
+def run_stream(output_file: BinaryIO) -> None:
+    if not pre_start():
+        output_file.close()
+        return
+    resolution = resolve_resolution(modules.globals.stream_input)
+    if not resolution:
+        modules.core.update_status('Select a stream resolution for pipe and fifo inputs.')
+        output_file.close()
+        return
+    width, height = resolution
+    frame_processors = get_frame_processors(modules.globals.frame_processors)
+    source_face = modules.core.get_source_face()
+    setup_frame_processors(frame_processors)
+    decoder = subprocess.Popen(get_decoder_command(modules.globals.stream_input, width, height), stdin=None if modules.globals.stream_input == '-' else subprocess.DEVNULL, stdout=subprocess.PIPE)
+    execution_threads = modules.globals.execution_threads or 1
+    frame_queue: queue.Queue = queue.Queue(maxsize=execution_threads)
+    result_queue: queue.Queue = queue.Queue()
+    STOP_EVENT.clear()
+    STREAM_STATS.clear()
+    STREAM_LATENCIES.clear()
+    STREAM_DETECTIONS.clear()
+    modules.core.update_status(f'Streaming {width}x{height} from {modules.globals.stream_input} with a {modules.globals.latency_budget} ms budget...')
+    reader = threading.Thread(target=read_frames, args=(decoder, width, height, frame_queue, result_queue), daemon=True)
+    workers = [threading.Thread(target=process_frames, args=(source_face, frame_processors, frame_queue, result_queue), daemon=True) for _ in range(execution_threads)]
+    writer = threading.Thread(target=write_frames, args=(output_file, result_queue), daemon=True)
+    for thread in [reader, writer] + workers:
+        thread.start()
+    reader.join()
+    decoder.terminate()
+    for _ in workers:
+        frame_queue.put(None)
+    for worker in workers:
+        worker.join()
+    result_queue.put(None)
+    writer.join()
+    decoder.wait()
+    output_file.close()
+    teardown_frame_processors(frame_processors)
+    report_stats()
@@ -1,7 +1,8 @@
 import os
+import queue
 import webbrowser
 import customtkinter as ctk
-from typing import Callable, Tuple
+from typing import Any, Callable, Dict, Tuple
 import cv2
 from PIL import Image, ImageOps
 
@@ -9,7 +10,7 @@ import modules.globals
 import modules.metadata
 from modules.face_analyser import get_one_face
 from modules.capturer import get_video_frame, get_video_frame_total
-from modules.processors.frame.core import get_frame_processors_modules
+from modules.processors.frame.core import get_frame_processors, process_batch
 from modules.utilities import is_image, is_video, resolve_relative_path
 
 ROOT = None
@@ -24,26 +25,34 @@ RECENT_DIRECTORY_SOURCE = None
 RECENT_DIRECTORY_TARGET = None
 RECENT_DIRECTORY_OUTPUT = None
 
+UI_QUEUE: 'queue.Queue[Tuple[str, Any]]' = queue.Queue()
+UI_POLL_INTERVAL = 100
+
 preview_label = None
 preview_slider = None
 source_label = None
 target_label = None
 status_label = None
+job_label = None
+
+SELECTION: Any = None
 
 img_ft, vid_ft = modules.globals.file_types
 
 
-def init(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.CTk:
-    global ROOT, PREVIEW
+def init(start: Callable[[], None], destroy: Callable[[], None], selection: Any = modules.globals) -> ctk.CTk:
+    global ROOT, PREVIEW, SELECTION
 
+    SELECTION = selection
     ROOT = create_root(start, destroy)
     PREVIEW = create_preview(ROOT)
+    ROOT.after(UI_POLL_INTERVAL, poll_ui_queue)
 
     return ROOT
 
 
 def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.CTk:
-    global source_label, target_label, status_label
+    global source_label, target_label, status_label, job_label
 
     ctk.deactivate_automatic_dpi_awareness()
     ctk.set_appearance_mode('system')
@@ -67,29 +76,29 @@ def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.C
     target_button = ctk.CTkButton(root, text='Select a target', cursor='hand2', command=lambda: select_target_path())
     target_button.place(relx=0.6, rely=0.4, relwidth=0.3, relheight=0.1)
 
-    keep_fps_value = ctk.BooleanVar(value=modules.globals.keep_fps)
-    keep_fps_checkbox = ctk.CTkSwitch(root, text='Keep fps', variable=keep_fps_value, cursor='hand2', command=lambda: setattr(modules.globals, 'keep_fps', not modules.globals.keep_fps))
+    keep_fps_value = ctk.BooleanVar(value=SELECTION.keep_fps)
+    keep_fps_checkbox = ctk.CTkSwitch(root, text='Keep fps', variable=keep_fps_value, cursor='hand2', command=lambda: setattr(SELECTION, 'keep_fps', not SELECTION.keep_fps))
     keep_fps_checkbox.place(relx=0.1, rely=0.6)
 
-    keep_frames_value = ctk.BooleanVar(value=modules.globals.keep_frames)
-    keep_frames_switch = ctk.CTkSwitch(root, text='Keep frames', variable=keep_frames_value, cursor='hand2', command=lambda: setattr(modules.globals, 'keep_frames', keep_frames_value.get()))
+    keep_frames_value = ctk.BooleanVar(value=SELECTION.keep_frames)
+    keep_frames_switch = ctk.CTkSwitch(root, text='Keep frames', variable=keep_frames_value, cursor='hand2', command=lambda: setattr(SELECTION, 'keep_frames', keep_frames_value.get()))
     keep_frames_switch.place(relx=0.1, rely=0.65)
 
     # for FRAME PROCESSOR ENHANCER tumbler:
-    enhancer_value = ctk.BooleanVar(value=modules.globals.fp_ui['face_enhancer'])
+    enhancer_value = ctk.BooleanVar(value=SELECTION.fp_ui['face_enhancer'])
     enhancer_switch = ctk.CTkSwitch(root, text='Face Enhancer', variable=enhancer_value, cursor='hand2', command=lambda: update_tumbler('face_enhancer',enhancer_value.get()))
     enhancer_switch.place(relx=0.1, rely=0.7)
 
-    keep_audio_value = ctk.BooleanVar(value=modules.globals.keep_audio)
-    keep_audio_switch = ctk.CTkSwitch(root, text='Keep audio', variable=keep_audio_value, cursor='hand2', command=lambda: setattr(modules.globals, 'keep_audio', keep_audio_value.get()))
+    keep_audio_value = ctk.BooleanVar(value=SELECTION.keep_audio)
+    keep_audio_switch = ctk.CTkSwitch(root, text='Keep audio', variable=keep_audio_value, cursor='hand2', command=lambda: setattr(SELECTION, 'keep_audio', keep_audio_value.get()))
     keep_audio_switch.place(relx=0.6, rely=0.6)
 
-    many_faces_value = ctk.BooleanVar(value=modules.globals.many_faces)
-    many_faces_switch = ctk.CTkSwitch(root, text='Many faces', variable=many_faces_value, cursor='hand2', command=lambda: setattr(modules.globals, 'many_faces', many_faces_value.get()))
+    many_faces_value = ctk.BooleanVar(value=SELECTION.many_faces)
+    many_faces_switch = ctk.CTkSwitch(root, text='Many faces', variable=many_faces_value, cursor='hand2', command=lambda: setattr(SELECTION, 'many_faces', many_faces_value.get()))
     many_faces_switch.place(relx=0.6, rely=0.65)
 
-    nsfw_value = ctk.BooleanVar(value=modules.globals.nsfw)
-    nsfw_switch = ctk.CTkSwitch(root, text='NSFW', variable=nsfw_value, cursor='hand2', command=lambda: setattr(modules.globals, 'nsfw', nsfw_value.get()))
+    nsfw_value = ctk.BooleanVar(value=SELECTION.nsfw)
+    nsfw_switch = ctk.CTkSwitch(root, text='NSFW', variable=nsfw_value, cursor='hand2', command=lambda: setattr(SELECTION, 'nsfw', nsfw_value.get()))
     nsfw_switch.place(relx=0.6, rely=0.7)
 
     start_button = ctk.CTkButton(root, text='Start', cursor='hand2', command=lambda: select_output_path(start))
@@ -101,6 +110,9 @@ def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.C
     preview_button = ctk.CTkButton(root, text='Preview', cursor='hand2', command=lambda: toggle_preview())
     preview_button.place(relx=0.65, rely=0.80, relwidth=0.2, relheight=0.05)
 
+    job_label = ctk.CTkLabel(root, text=None, justify='center')
+    job_label.place(relx=0.1, rely=0.86, relwidth=0.8)
+
     status_label = ctk.CTkLabel(root, text=None, justify='center')
     status_label.place(relx=0.1, rely=0.9, relwidth=0.8)
 
@@ -131,12 +143,37 @@ def create_preview(parent: ctk.CTkToplevel) -> ctk.CTkToplevel:
 
 
 def update_status(text: str) -> None:
-    status_label.configure(text=text)
-    ROOT.update()
+    UI_QUEUE.put(('status', text))
+
+
+def update_job(event: Dict[str, Any]) -> None:
+    UI_QUEUE.put(('job', event))
+
+
+def poll_ui_queue() -> None:
+    while not UI_QUEUE.empty():
+        kind, value = UI_QUEUE.get_nowait()
+        if kind == 'status':
+            status_label.configure(text=value)
+        if kind == 'job':
+            job_label.configure(text=format_job_event(value))
+    ROOT.after(UI_POLL_INTERVAL, poll_ui_queue)
+
+
+def format_job_event(event: Dict[str, Any]) -> str:
+    text = f"Job {event['job']} {event['status']}"
+    if event.get('total'):
+        text += f" {event['frames']}/{event['total']} frames"
+    if event.get('fps'):
+        text += f" {event['fps']:.1f} fps"
+    if event.get('eta') is not None:
+        minutes, seconds = divmod(int(event['eta']), 60)
+        text += f' ETA {minutes:02d}:{seconds:02d}'
+    return text + f" | {event['pending']} pending"
 
 
 def update_tumbler(var: str, value: bool) -> None:
-    modules.globals.fp_ui[var] = value
+    SELECTION.fp_ui[var] = value
 
 
 def select_source_path() -> None:
@@ -145,12 +182,12 @@ def select_source_path() -> None:
     PREVIEW.withdraw()
     source_path = ctk.filedialog.askopenfilename(title='select an source image', initialdir=RECENT_DIRECTORY_SOURCE, filetypes=[img_ft])
     if is_image(source_path):
-        modules.globals.source_path = source_path
-        RECENT_DIRECTORY_SOURCE = os.path.dirname(modules.globals.source_path)
-        image = render_image_preview(modules.globals.source_path, (200, 200))
+        SELECTION.source_path = source_path
+        RECENT_DIRECTORY_SOURCE = os.path.dirname(SELECTION.source_path)
+        image = render_image_preview(SELECTION.source_path, (200, 200))
         source_label.configure(image=image)
     else:
-        modules.globals.source_path = None
+        SELECTION.source_path = None
         source_label.configure(image=None)
 
 
@@ -160,32 +197,32 @@ def select_target_path() -> None:
     PREVIEW.withdraw()
     target_path = ctk.filedialog.askopenfilename(title='select an target image or video', initialdir=RECENT_DIRECTORY_TARGET, filetypes=[img_ft, vid_ft])
     if is_image(target_path):
-        modules.globals.target_path = target_path
-        RECENT_DIRECTORY_TARGET = os.path.dirname(modules.globals.target_path)
-        image = render_image_preview(modules.globals.target_path, (200, 200))
+        SELECTION.target_path = target_path
+        RECENT_DIRECTORY_TARGET = os.path.dirname(SELECTION.target_path)
+        image = render_image_preview(SELECTION.target_path, (200, 200))
         target_label.configure(image=image)
     elif is_video(target_path):
-        modules.globals.target_path = target_path
-        RECENT_DIRECTORY_TARGET = os.path.dirname(modules.globals.target_path)
+        SELECTION.target_path = target_path
+        RECENT_DIRECTORY_TARGET = os.path.dirname(SELECTION.target_path)
         video_frame = render_video_preview(target_path, (200, 200))
         target_label.configure(image=video_frame)
     else:
-        modules.globals.target_path = None
+        SELECTION.target_path = None
         target_label.configure(image=None)
 
 
 def select_output_path(start: Callable[[], None]) -> None:
     global RECENT_DIRECTORY_OUTPUT, img_ft, vid_ft
 
-    if is_image(modules.globals.target_path):
+    if is_image(SELECTION.target_path):
         output_path = ctk.filedialog.asksaveasfilename(title='save image output file', filetypes=[img_ft], defaultextension='.png', initialfile='output.png', initialdir=RECENT_DIRECTORY_OUTPUT)
-    elif is_video(modules.globals.target_path):
+    elif is_video(SELECTION.target_path):
         output_path = ctk.filedialog.asksaveasfilename(title='save video output file', filetypes=[vid_ft], defaultextension='.mp4', initialfile='output.mp4', initialdir=RECENT_DIRECTORY_OUTPUT)
     else:
         output_path = None
     if output_path:
-        modules.globals.output_path = output_path
-        RECENT_DIRECTORY_OUTPUT = os.path.dirname(modules.globals.output_path)
+        SELECTION.output_path = output_path
+        RECENT_DIRECTORY_OUTPUT = os.path.dirname(SELECTION.output_path)
         start()
 
 
@@ -213,34 +250,32 @@ def render_video_preview(video_path: str, size: Tuple[int, int], frame_number: i
 def toggle_preview() -> None:
     if PREVIEW.state() == 'normal':
         PREVIEW.withdraw()
-    elif modules.globals.source_path and modules.globals.target_path:
+    elif SELECTION.source_path and SELECTION.target_path:
         init_preview()
         update_preview()
         PREVIEW.deiconify()
 
 
 def init_preview() -> None:
-    if is_image(modules.globals.target_path):
+    if is_image(SELECTION.target_path):
         preview_slider.pack_forget()
-    if is_video(modules.globals.target_path):
-        video_frame_total = get_video_frame_total(modules.globals.target_path)
+    if is_video(SELECTION.target_path):
+        video_frame_total = get_video_frame_total(SELECTION.target_path)
         preview_slider.configure(to=video_frame_total)
         preview_slider.pack(fill='x')
         preview_slider.set(0)
 
 
 def update_preview(frame_number: int = 0) -> None:
-    if modules.globals.source_path and modules.globals.target_path:
-        temp_frame = get_video_frame(modules.globals.target_path, frame_number)
-        if modules.globals.nsfw == False:
+    if SELECTION.source_path and SELECTION.target_path:
+        temp_frame = get_video_frame(SELECTION.target_path, frame_number)
+        if SELECTION.nsfw == False:
             from modules.predicter import predict_frame
             if predict_frame(temp_frame):
                 quit()
-        for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-            temp_frame = frame_processor.process_frame(
-                get_one_face(cv2.imread(modules.globals.source_path)),
-                temp_frame
-            )
+        source_face = get_one_face(cv2.imread(SELECTION.source_path))
+        # the preview follows the switches, modules.globals belongs to the running job
+        temp_frame = process_batch(source_face, [temp_frame], get_frame_processors(list(SELECTION.frame_processors), SELECTION.fp_ui), settings=SELECTION)[0]
         image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
         image = ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
         image = ctk.CTkImage(image, size=image.size)
@@ -1,4 +1,5 @@
 import glob
+import hashlib
 import mimetypes
 import os
 import platform
@@ -7,13 +8,17 @@ import ssl
 import subprocess
 import urllib
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Optional, Tuple
+import cv2
 from tqdm import tqdm
 
 import modules.globals
+import modules.frame_store as frame_store
+from modules.typing import Frame
 
 TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
+TEMP_FRAME_FORMAT = '%08d.png'
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
@@ -42,41 +47,169 @@ def detect_fps(target_path: str) -> float:
     return 30.0
 
 
-def extract_frames(target_path: str) -> None:
-    temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
+def resolve_frame_range(target_path: str, start_time: Optional[float], end_time: Optional[float], start_frame: Optional[int], end_frame: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+    if (start_time is not None or end_time is not None) and target_path and os.path.isfile(target_path):
+        fps = detect_fps(target_path)
+        if start_frame is None and start_time is not None:
+            start_frame = round(start_time * fps)
+        if end_frame is None and end_time is not None:
+            end_frame = round(end_time * fps)
+    if start_frame is not None and end_frame is not None and end_frame <= start_frame:
+        raise ValueError(f'end frame {end_frame} is not after start frame {start_frame}')
+    return start_frame or None, end_frame
+
+
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'csv=p=0', target_path]
+    output = subprocess.check_output(command).decode().strip().split(',')
+    width, height = map(int, output[:2])
+    return width, height
+
+
+def detect_frame_total(target_path: str) -> int:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', target_path]
+    output = subprocess.check_output(command).decode().strip().rstrip(',')
+    try:
+        return int(output)
+    except ValueError:
+        pass
+    return 0
 
 
-def create_video(target_path: str, fps: float = 30.0) -> None:
+def get_input_range_args(target_path: str, start_frame: Optional[int], end_frame: Optional[int]) -> List[str]:
+    if not start_frame and end_frame is None:
+        return ['-i', target_path]
+    # seek before -i so only the range is decoded
+    fps = detect_fps(target_path)
+    input_args = []
+    if start_frame:
+        input_args.extend(['-ss', str(start_frame / fps)])
+    if end_frame is not None:
+        input_args.extend(['-t', str((end_frame - (start_frame or 0)) / fps)])
+    return input_args + ['-i', target_path]
+
+
+def get_output_range_args(start_frame: Optional[int], end_frame: Optional[int]) -> List[str]:
+    if end_frame is not None:
+        return ['-frames:v', str(end_frame - (start_frame or 0))]
+    return []
+
+
+def extract_frames(target_path: str) -> bool:
+    if modules.globals.frame_store:
+        return extract_frames_to_store(target_path)
+    temp_directory_path = get_temp_directory_path(target_path)
+    input_args = get_input_range_args(target_path, modules.globals.start_frame, modules.globals.end_frame)
+    return run_ffmpeg(input_args + get_output_range_args(modules.globals.start_frame, modules.globals.end_frame) + ['-pix_fmt', 'rgb24', os.path.join(temp_directory_path, TEMP_FRAME_FORMAT)])
+
+
+def extract_frames_to_store(target_path: str) -> bool:
+    store_path = get_frame_store_path(target_path)
+    width, height = detect_resolution(target_path)
+    # counting packets reads the whole target, a closed range is sized without it and a short read truncates the store
+    if modules.globals.end_frame is not None:
+        frame_total = modules.globals.end_frame - (modules.globals.start_frame or 0)
+    else:
+        frame_total = detect_frame_total(target_path) - (modules.globals.start_frame or 0)
+    if frame_total <= 0 or not frame_store.has_free_space(os.path.dirname(store_path), frame_total, height, width):
+        return False
+    store = frame_store.create_frame_store(store_path, frame_total, height, width)
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level] + get_input_range_args(target_path, modules.globals.start_frame, modules.globals.end_frame) + ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-vsync', 'passthrough', '-']
+    frame_number = 0
+    with subprocess.Popen(commands, stdout=subprocess.PIPE) as process:
+        while frame_number < frame_total:
+            # decode straight into the mapped frame, no intermediate buffer
+            view = memoryview(store[frame_number]).cast('B')
+            size = 0
+            while size < len(view):
+                count = process.stdout.readinto(view[size:])
+                if not count:
+                    break
+                size += count
+            if size < len(view):
+                break
+            frame_number += 1
+        # a short read is only fine when ffmpeg ended cleanly, the packet count can overestimate
+        if frame_number < frame_total and process.wait() != 0:
+            return False
+        process.kill()
+    frame_store.truncate_frame_store(store_path, frame_number)
+    return frame_number > 0
+
+
+def create_video(target_path: str, fps: float = 30.0, video_encoder: Optional[str] = None, video_quality: Optional[int] = None) -> None:
+    if video_encoder is None:
+        video_encoder = modules.globals.video_encoder
+    if video_quality is None:
+        video_quality = modules.globals.video_quality
     temp_output_path = get_temp_output_path(target_path)
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.png'), '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
+    store_path = get_frame_store_path(target_path)
+    if modules.globals.frame_store:
+        frame_store.close_frame_store(store_path)
+        frame_total, height, width = frame_store.read_header(store_path)
+        inputs = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-skip_initial_bytes', str(frame_store.FRAME_STORE_HEADER_SIZE), '-i', store_path, '-frames:v', str(frame_total)]
+    else:
+        inputs = ['-r', str(fps), '-i', os.path.join(temp_directory_path, TEMP_FRAME_FORMAT)]
+    run_ffmpeg(inputs + ['-c:v', video_encoder, '-crf', str(video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
 
 
-def restore_audio(target_path: str, output_path: str) -> None:
+def restore_audio(target_path: str, output_path: str, start_frame: Optional[int] = None, end_frame: Optional[int] = None) -> None:
     temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
+    done = run_ffmpeg(['-i', temp_output_path] + get_input_range_args(target_path, start_frame, end_frame) + ['-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
     if not done:
         move_temp(target_path, output_path)
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
+    if modules.globals.frame_store:
+        return frame_store.get_frame_references(get_frame_store_path(target_path))
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    return sorted(glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png'))))
+
+
+def get_temp_frame_number(temp_frame_path: str) -> int:
+    if frame_store.is_frame_reference(temp_frame_path):
+        _, frame_number = frame_store.parse_frame_reference(temp_frame_path)
+        return frame_number
+    temp_frame_name, _ = os.path.splitext(os.path.basename(temp_frame_path))
+    return int(temp_frame_name) - 1
+
+
+def read_temp_frame(temp_frame_path: str) -> Frame:
+    if frame_store.is_frame_reference(temp_frame_path):
+        return frame_store.read_frame(temp_frame_path)
+    return cv2.imread(temp_frame_path)
+
+
+def write_temp_frame(temp_frame_path: str, frame: Frame) -> None:
+    if frame_store.is_frame_reference(temp_frame_path):
+        frame_store.write_frame(temp_frame_path, frame)
+    else:
+        cv2.imwrite(temp_frame_path, frame)
 
 
 def get_temp_directory_path(target_path: str) -> str:
     target_name, _ = os.path.splitext(os.path.basename(target_path))
+    if modules.globals.temp_directory:
+        return os.path.join(modules.globals.temp_directory, TEMP_DIRECTORY, target_name)
     target_directory_path = os.path.dirname(target_path)
     return os.path.join(target_directory_path, TEMP_DIRECTORY, target_name)
 
 
+def get_frame_store_path(target_path: str) -> str:
+    temp_directory_path = get_temp_directory_path(target_path)
+    return os.path.join(temp_directory_path, frame_store.FRAME_STORE_FILE)
+
+
 def get_temp_output_path(target_path: str) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
     return os.path.join(temp_directory_path, TEMP_FILE)
 
 
 def normalize_output_path(source_path: str, target_path: str, output_path: str) -> Any:
+    if is_image_directory(target_path):
+        return output_path
     if source_path and target_path:
         source_name, _ = os.path.splitext(os.path.basename(source_path))
         target_name, target_extension = os.path.splitext(os.path.basename(target_path))
@@ -98,10 +231,13 @@ def move_temp(target_path: str, output_path: str) -> None:
         shutil.move(temp_output_path, output_path)
 
 
-def clean_temp(target_path: str) -> None:
+def clean_temp(target_path: str, keep_frames: Optional[bool] = None) -> None:
+    if keep_frames is None:
+        keep_frames = modules.globals.keep_frames
     temp_directory_path = get_temp_directory_path(target_path)
     parent_directory_path = os.path.dirname(temp_directory_path)
-    if not modules.globals.keep_frames and os.path.isdir(temp_directory_path):
+    frame_store.close_frame_store(get_frame_store_path(target_path))
+    if not keep_frames and os.path.isdir(temp_directory_path):
         shutil.rmtree(temp_directory_path)
     if os.path.exists(parent_directory_path) and not os.listdir(parent_directory_path):
         os.rmdir(parent_directory_path)
@@ -118,6 +254,14 @@ def is_image(image_path: str) -> bool:
     return False
 
 
+def is_image_directory(directory_path: str) -> bool:
+    return bool(directory_path) and os.path.isdir(directory_path)
+
+
+def get_image_paths(directory_path: str) -> List[str]:
+    return sorted(os.path.join(directory_path, file_name) for file_name in os.listdir(directory_path) if has_image_extension(file_name) and is_image(os.path.join(directory_path, file_name)))
+
+
 def is_video(video_path: str) -> bool:
     if video_path and os.path.isfile(video_path):
         mimetype, _ = mimetypes.guess_type(video_path)
@@ -137,5 +281,13 @@ def conditional_download(download_directory_path: str, urls: List[str]) -> None:
                 urllib.request.urlretrieve(url, download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size)) # type: ignore[attr-defined]
 
 
+def get_file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def resolve_relative_path(path: str) -> str:
     return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
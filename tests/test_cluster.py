@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+
+import pytest
+
+import modules.globals
+import modules.cluster as cluster
+from modules.utilities import get_file_digest
+
+
+@pytest.fixture(autouse=True)
+def reset_cluster() -> None:
+    modules.globals.headless = True
+    cluster.create_tasks(0, 0, 1)
+    yield
+    cluster.create_tasks(0, 0, 1)
+
+
+def create_segment(tmp_path, name: str) -> str:
+    segment_path = os.path.join(tmp_path, name)
+    with open(segment_path, 'wb') as segment_file:
+        segment_file.write(name.encode())
+    return segment_path
+
+
+def test_create_tasks_splits_the_range() -> None:
+    cluster.create_tasks(10, 35, 10)
+    assert [(task['start_frame'], task['end_frame']) for task in cluster.TASKS] == [(10, 20), (20, 30), (30, 35)]
+
+
+def test_next_task_hands_out_every_range_once() -> None:
+    cluster.create_tasks(0, 20, 10)
+    first_task = cluster.next_task('a')
+    second_task = cluster.next_task('b')
+    assert {first_task['id'], second_task['id']} == {0, 1}
+
+
+def test_failed_task_is_retried_until_max_attempts() -> None:
+    cluster.create_tasks(0, 10, 10)
+    for attempt in range(cluster.MAX_ATTEMPTS):
+        task = cluster.next_task('a')
+        assert task['attempts'] == attempt + 1
+        assert not cluster.is_failed()
+        cluster.finish_task(task, 'a', None)
+    assert cluster.is_failed()
+    assert cluster.is_finished()
+    assert cluster.next_task('a') is None
+
+
+def test_straggler_is_reassigned_and_first_result_wins(tmp_path) -> None:
+    cluster.create_tasks(0, 20, 10)
+    fast_task = cluster.next_task('a')
+    cluster.finish_task(fast_task, 'a', create_segment(tmp_path, 'fast.mp4'))
+    slow_task = cluster.next_task('b')
+    slow_task['running']['b'] = time.time() - 3600
+    assert cluster.next_task('c') is slow_task
+    cluster.finish_task(slow_task, 'c', create_segment(tmp_path, 'c.mp4'))
+    late_segment_path = create_segment(tmp_path, 'b.mp4')
+    cluster.finish_task(slow_task, 'b', late_segment_path)
+    assert slow_task['segment_path'].endswith('c.mp4')
+    assert not os.path.exists(late_segment_path)
+    assert cluster.is_finished() and not cluster.is_failed()
+
+
+def test_straggler_is_not_reassigned_past_max_attempts(tmp_path) -> None:
+    cluster.create_tasks(0, 20, 10)
+    fast_task = cluster.next_task('a')
+    cluster.finish_task(fast_task, 'a', create_segment(tmp_path, 'fast.mp4'))
+    slow_task = cluster.next_task('b')
+    slow_task['attempts'] = cluster.MAX_ATTEMPTS
+    slow_task['running']['b'] = time.time() - 3600
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(cluster.next_task('c')))
+    waiter.start()
+    waiter.join(1.5)
+    assert waiter.is_alive()
+    cluster.finish_task(slow_task, 'b', create_segment(tmp_path, 'b.mp4'))
+    waiter.join(5)
+    assert results == [None]
+
+
+def test_workers_on_localhost(tmp_path, monkeypatch) -> None:
+    source_path = create_segment(tmp_path, 'source.jpg')
+    target_path = create_segment(tmp_path, 'target.mp4')
+    processed = []
+
+    def process_task(task, files, cache_directory_path):
+        with open(files['source'], 'rb') as source_file:
+            assert source_file.read() == b'source.jpg'
+        processed.append((task['start_frame'], threading.current_thread().name))
+        return create_segment(cache_directory_path, f"segment-{task['start_frame']}-{task['end_frame']}.mp4")
+
+    monkeypatch.setattr(cluster, 'process_task', process_task)
+    cluster.create_tasks(0, 100, 10)
+    segment_directory_path = tmp_path / 'segments'
+    segment_directory_path.mkdir()
+    server = cluster.create_server('127.0.0.1:0')
+    monkeypatch.setattr(modules.globals, 'worker', f'127.0.0.1:{server.getsockname()[1]}')
+    files = {kind: (file_path, get_file_digest(file_path)) for kind, file_path in [('source', source_path), ('target', target_path)]}
+    threading.Thread(target=cluster.accept_workers, args=(server, {}, files, str(segment_directory_path)), daemon=True).start()
+    workers = [threading.Thread(target=cluster.run_worker, name=f'worker-{index}', daemon=True) for index in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+    server.close()
+    assert cluster.is_finished() and not cluster.is_failed()
+    assert sorted(start_frame for start_frame, _ in processed) == list(range(0, 100, 10))
+    for task in cluster.TASKS:
+        with open(task['segment_path'], 'rb') as segment_file:
+            assert segment_file.read() == f"segment-{task['start_frame']}-{task['end_frame']}.mp4".encode()